@@ -0,0 +1,365 @@
+"""
+Benchmarks for fie_lonet_switch at scale.
+
+Builds synthetic databases and template sets in a throwaway home directory, times the
+database functions in isolation and every CLI command end to end, and writes the
+results as JSON so runs can be compared between commits:
+
+    python benchmarks/bench.py run --groups 1000 --groups 100000 --history 1000000 \\
+        --templates 10 --templates 500 --output after.json
+    python benchmarks/bench.py compare before.json after.json --threshold 0.2
+
+Every timing is the wall clock time of one operation in seconds; min, median and mean are
+reported over --repeat runs.  compare exits non-zero if any median regressed by more
+than the threshold.
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import click
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+# Benchmark the working tree, not whatever version happens to be installed.
+sys.path.insert(0, str(REPO_ROOT))
+
+
+def _timings(durations: List[float]) -> Dict[str, Any]:
+    return {
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+        "runs": len(durations),
+    }
+
+
+def time_it(func: Callable[[], Any], repeat: int, setup: Optional[Callable[[], Any]] = None) -> Dict[str, Any]:
+    """Time func repeat times. setup runs untimed before every run."""
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return _timings(durations)
+
+
+def time_per_call(func: Callable[[], Any], repeat: int, calls: int) -> Dict[str, Any]:
+    """Time calls of a fast func in batches; reports the time of a single call."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        durations.append((time.perf_counter() - start) / calls)
+    return _timings(durations)
+
+
+def group_name(index: int) -> str:
+    return f"group{index:06d}"
+
+
+def populate_history(db_path: str, groups: int, history: int, seed: int = 0) -> None:
+    """
+    Fill a database with `history` switch changes spread over `groups` groups, plus one
+    early "*" change, then rebuild current_state.
+    """
+    from fie_lonet_switch.database import SwitchStateChangeRow, SwitchStateDB
+
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    start_epoch_us = int(start.timestamp()) * 1_000_000
+    db = SwitchStateDB(db_path)
+    try:
+        db.begin(immediate=True)
+        rows = [SwitchStateChangeRow(
+            str(uuid.UUID(int=rng.getrandbits(128))), start.isoformat(), "lo", "*", "", 1, start_epoch_us,
+        )]
+        for index in range(1, max(history, groups) + 1):
+            # Every group gets at least one change; the rest are spread at random.
+            group = group_name(index - 1 if index <= groups else rng.randrange(groups))
+            rows.append(SwitchStateChangeRow(
+                str(uuid.UUID(int=rng.getrandbits(128))),
+                (start + timedelta(milliseconds=index)).isoformat(),
+                rng.choice(("lo", "net")),
+                group,
+                rng.choice(("", "us-east", "eu")),
+                index + 1,
+                start_epoch_us + index * 1000,
+            ))
+        db.create_switch_state_changes(rows)
+        db.rebuild_current_state()
+        db.commit()
+    finally:
+        db.close()
+
+
+def populate_templates(db_path: str, template_dir: Path, templates: int, groups: int) -> None:
+    """Write `templates` jinja templates and register them, spread over the groups."""
+    from fie_lonet_switch.database import JinjaTemplateRow, SwitchStateDB
+
+    template_dir.mkdir(parents=True, exist_ok=True)
+    body = "\n".join(
+        f"setting_{line} = {{{{ 'local' if fie_lonet_switch.switch.switch_to == 'lo' else 'remote' }}}}-{line}"
+        for line in range(200)
+    )
+    db = SwitchStateDB(db_path)
+    try:
+        db.begin(immediate=True)
+        rows = []
+        for index in range(templates):
+            path = template_dir / f"config{index:04d}.conf.jinja"
+            path.write_text(body)
+            rows.append(JinjaTemplateRow(str(uuid.UUID(int=index)), str(path), group_name(index % groups)))
+        db.create_jinja_templates(rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+def bench_database(db_path: str, groups: int, repeat: int, calls: int) -> Dict[str, Any]:
+    """Time the database functions in isolation against a populated database."""
+    from fie_lonet_switch.database import (
+        SwitchStateDB,
+        clear_group_transaction,
+        compact_db_transaction,
+        get_switch_state_transaction,
+        switch_change_transaction,
+    )
+
+    results: Dict[str, Any] = {}
+    scratch = db_path + ".scratch"
+
+    def restore_scratch():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(scratch + suffix):
+                os.remove(scratch + suffix)
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(scratch)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    results["db.open"] = time_it(lambda: SwitchStateDB(db_path).close(), repeat)
+
+    db = SwitchStateDB(db_path)
+    try:
+        present = group_name(groups // 2)
+        results["db.get_switch_state_transaction"] = time_per_call(
+            lambda: get_switch_state_transaction(db, present), repeat, calls
+        )
+        results["db.get_switch_state_transaction.missing_group"] = time_per_call(
+            lambda: get_switch_state_transaction(db, "no-such-group"), repeat, calls
+        )
+        results["db.get_all_groups"] = time_it(db.get_all_groups, repeat)
+        results["db.get_all_resolved_states"] = time_it(db.get_all_resolved_states, repeat)
+        results["db.get_all_jinja_templates"] = time_it(db.get_all_jinja_templates, repeat)
+        results["db.get_all_jinja_template_rows"] = time_it(db.get_all_jinja_template_rows, repeat)
+        results["db.get_all_switch_state_changes"] = time_it(db.get_all_switch_state_changes, repeat)
+        results["db.get_all_switch_state_change_rows"] = time_it(db.get_all_switch_state_change_rows, repeat)
+    finally:
+        db.close()
+
+    scratch_db: List[Any] = []
+
+    def open_scratch():
+        for opened in scratch_db:
+            opened.close()
+        scratch_db.clear()
+        restore_scratch()
+        scratch_db.append(SwitchStateDB(scratch))
+
+    open_scratch()
+    results["db.switch_change_transaction"] = time_it(
+        lambda: switch_change_transaction(scratch_db[0], "net", group_name(random.randrange(groups)), "eu"), repeat
+    )
+    results["db.clear_group_transaction"] = time_it(
+        lambda: clear_group_transaction(scratch_db[0], group_name(random.randrange(groups))), repeat
+    )
+    results["db.switch_change_transaction.all_groups"] = time_it(
+        lambda: switch_change_transaction(scratch_db[0], "lo", "*", ""), repeat, setup=open_scratch
+    )
+    results["db.compact_db_transaction"] = time_it(
+        lambda: compact_db_transaction(scratch_db[0]), repeat, setup=open_scratch
+    )
+    for opened in scratch_db:
+        opened.close()
+    return results
+
+
+def bench_render(db_path: str, repeat: int, workers: int) -> Dict[str, Any]:
+    """Time rendering every registered template: first, changed and unchanged output."""
+    from fie_lonet_switch.database import SwitchStateDB
+    from fie_lonet_switch.switcher import do_switch_jinjas_in_db
+
+    results: Dict[str, Any] = {}
+    db = SwitchStateDB(db_path)
+    try:
+        # Compiles every template once, as the first switch after an install would.
+        results["render.all_templates.first"] = time_it(
+            lambda: do_switch_jinjas_in_db("lo", "*", "", db, workers), 1
+        )
+        modes = iter(["net", "lo"] * repeat)
+        results["render.all_templates.changed"] = time_it(
+            lambda: do_switch_jinjas_in_db(next(modes), "*", "", db, workers), 2 * repeat
+        )
+        # The last changed render was to "lo".
+        results["render.all_templates.unchanged"] = time_it(
+            lambda: do_switch_jinjas_in_db("lo", "*", "", db, workers), repeat
+        )
+    finally:
+        db.close()
+    return results
+
+
+def bench_cli(home: Path, groups: int, repeat: int) -> Dict[str, Any]:
+    """Time CLI commands end to end, each in a new process, as a user would run them."""
+    from fie_lonet_switch import cli
+
+    env = dict(os.environ, HOME=str(home), USERPROFILE=str(home))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO_ROOT), env.get("PYTHONPATH")]))
+    group = group_name(groups // 2)
+    commands = {
+        "cli.status": [cli.status.name],
+        "cli.status.group": [cli.status.name, group],
+        "cli.list_all": [cli.list_all.name],
+        "cli.jinjas_list": [cli.jinjas.name, "list"],
+        "cli.switch.group": [cli.switch.name, "net", group, "eu"],
+        "cli.clear_group": [cli.clear_group.name, group_name(groups - 1)],
+        # Last, so that the commands above run against the full history.
+        "cli.compact": [cli.compact.name],
+    }
+    results: Dict[str, Any] = {}
+    for name, args in commands.items():
+        argv = [sys.executable, "-m", "fie_lonet_switch.cli", *args]
+        results[name] = time_it(
+            lambda: subprocess.run(argv, env=env, check=True, stdout=subprocess.DEVNULL), repeat
+        )
+    return results
+
+
+def _metadata(**params: Any) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "created": datetime.now().isoformat(),
+        "params": params,
+    }
+
+
+@click.group()
+def main():
+    """fie_lonet_switch benchmarks."""
+    pass
+
+
+@main.command()
+@click.option("--groups", "groups_list", type=click.IntRange(min=1), multiple=True, default=[1000], show_default=True,
+              help="Number of groups in the synthetic database. May be given more than once.")
+@click.option("--history", type=click.IntRange(min=1), default=100000, show_default=True,
+              help="Number of switch_state_change rows in the synthetic database.")
+@click.option("--templates", "templates_list", type=click.IntRange(min=1), multiple=True, default=[50],
+              show_default=True, help="Number of registered jinja templates. May be given more than once.")
+@click.option("--repeat", type=click.IntRange(min=1), default=5, show_default=True, help="Runs per benchmark.")
+@click.option("--calls", type=click.IntRange(min=1), default=200, show_default=True,
+              help="Calls per run for the fast per-call benchmarks.")
+@click.option("--render-workers", type=click.IntRange(min=1), default=4, show_default=True)
+@click.option("--cli/--no-cli", "with_cli", default=True, help="Also time the CLI commands end to end.")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="Write the JSON results to a file.")
+def run(groups_list, history, templates_list, repeat, calls, render_workers, with_cli, output):
+    """Run the benchmarks and print or save the JSON results."""
+    work_dir = Path(tempfile.mkdtemp(prefix="fie_lonet_switch_bench_"))
+    # Everything, including the jinja bytecode cache, lives under a throwaway home.
+    os.environ["HOME"] = os.environ["USERPROFILE"] = str(work_dir / "home")
+    results: Dict[str, Any] = {}
+    try:
+        for groups in groups_list:
+            home = work_dir / f"groups{groups}" / "home"
+            db_path = home / ".fie_lonet_switch" / "switch_state.sql"
+            db_path.parent.mkdir(parents=True)
+            click.echo(f"Building database: {groups} groups, {max(history, groups)} changes", err=True)
+            populate_history(str(db_path), groups, history)
+            populate_templates(str(db_path), home / "templates", min(templates_list), groups)
+            suffix = f"[groups={groups},history={max(history, groups)}]"
+            for name, timing in bench_database(str(db_path), groups, repeat, calls).items():
+                results[name + suffix] = timing
+            if with_cli:
+                for name, timing in bench_cli(home, groups, repeat).items():
+                    results[name + suffix] = timing
+
+        for templates in templates_list:
+            home = work_dir / f"templates{templates}" / "home"
+            db_path = home / ".fie_lonet_switch" / "switch_state.sql"
+            db_path.parent.mkdir(parents=True)
+            click.echo(f"Building template set: {templates} templates", err=True)
+            populate_history(str(db_path), 10, 10)
+            populate_templates(str(db_path), home / "templates", templates, 10)
+            suffix = f"[templates={templates},workers={render_workers}]"
+            for name, timing in bench_render(str(db_path), repeat, render_workers).items():
+                results[name + suffix] = timing
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": _metadata(
+            groups=list(groups_list), history=history, templates=list(templates_list),
+            repeat=repeat, calls=calls, render_workers=render_workers,
+        ),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        Path(output).write_text(text)
+        click.echo(f"Results written to {output}", err=True)
+    else:
+        click.echo(text)
+
+
+@main.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("candidate", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", type=float, default=0.2, show_default=True,
+              help="Relative slowdown of the median that counts as a regression.")
+def compare(baseline, candidate, threshold):
+    """Compare two result files. Exits non-zero if anything regressed."""
+    old = json.loads(Path(baseline).read_text())["results"]
+    new = json.loads(Path(candidate).read_text())["results"]
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]["median"], new[name]["median"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        click.echo(f"{name}: {before * 1000:.3f} ms -> {after * 1000:.3f} ms ({ratio:.2f}x){flag}")
+    for name in sorted(set(old) ^ set(new)):
+        click.echo(f"{name}: only in {'baseline' if name in old else 'candidate'}")
+    if regressions:
+        click.echo(f"{regressions} regression(s) over {threshold:.0%}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Import time regression check for `fie_lonet_switch status`.
+
+Runs the status command under `python -X importtime` against a throwaway home
+directory and fails if it imports pydantic or jinja2, or if its total import time
+exceeds the budget.
+
+    python benchmarks/status_import_budget.py --budget-ms 60
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict
+
+import click
+
+# Modules only switch and template commands need.
+FORBIDDEN_MODULES = ("pydantic", "jinja2")
+
+STATUS_SNIPPET = "from fie_lonet_switch.cli import main; main(['status'], standalone_mode=False)"
+
+
+def measure_status_imports(home: str) -> Dict[str, int]:
+    """
+    Run the status command under -X importtime.
+    Returns:
+        Dict[str, int]: Cumulative import time in microseconds per top level module.
+    """
+    env = dict(os.environ, HOME=home, USERPROFILE=home)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STATUS_SNIPPET],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    top_level: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # The module name follows a single space; nested imports are indented further.
+        module = name.rstrip()[1:]
+        if not module.startswith(" "):
+            top_level[module.strip()] = int(cumulative)
+        else:
+            top_level.setdefault(module.strip(), 0)
+    return top_level
+
+
+@click.command()
+@click.option("--budget-ms", type=float, default=100.0, show_default=True,
+              help="Maximum total import time for the status command.")
+@click.option("--runs", type=click.IntRange(min=1), default=5, show_default=True,
+              help="Number of runs; the fastest one is compared to the budget.")
+def main(budget_ms, runs):
+    """Check the import time budget of `fie_lonet_switch status`."""
+    with tempfile.TemporaryDirectory() as home:
+        measurements = [measure_status_imports(home) for _ in range(runs)]
+    imported = measurements[0]
+    forbidden = sorted({name.split(".")[0] for name in imported} & set(FORBIDDEN_MODULES))
+    total_ms = min(sum(m.values()) for m in measurements) / 1000.0
+    click.echo(f"status import time: {total_ms:.1f} ms (budget {budget_ms:.1f} ms)")
+    failed = False
+    if forbidden:
+        click.echo(f"FAIL: status imports {', '.join(forbidden)}")
+        failed = True
+    if total_ms > budget_ms:
+        click.echo("FAIL: status import time is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
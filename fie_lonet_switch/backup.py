@@ -0,0 +1,262 @@
+"""
+Export and import of the switch state as JSON lines, e.g. to provision a new machine from a
+reference profile.
+
+An export is a header line followed by one line per row of the switch history, the current
+state and the registered templates:
+
+    {"type": "header", "format": "fie_lonet_switch", "v": 1, "schema_version": 9, "exported": "..."}
+    {"type": "history", "id": "...", "c_time": "...", "mode": "net", "group": "*", "locale": "de", "seq": 1, "c_epoch_us": ...}
+    {"type": "current_state", "id": "...", "c_time": "...", "mode": "net", "group": "*", "locale": "de", "seq": 1, "c_epoch_us": ...}
+    {"type": "template", "id": "...", "path": "/home/me/.gitconfig.jinja", "group": "*"}
+
+Exports are read in a single read transaction, so they are a consistent snapshot even while
+other processes switch, and rows are streamed rather than loaded into memory.  Imports are
+written in batches with executemany inside a single transaction, so a failed import leaves the
+database as it was.  Imported changes are given new sequence numbers, in their exported order
+or, when merging, in c_time order.  seq and c_epoch_us may be left out, as in exports of
+databases from before they were added.  Settings and side effect jobs are machine specific and
+are not exported.
+"""
+import json
+import sqlite3
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Tuple
+
+from fie_lonet_switch.database import (
+    DEFAULT_BUSY_TIMEOUT,
+    SCHEMA_VERSION,
+    JinjaTemplateRow,
+    SwitchStateChangeRow,
+    SwitchStateDB,
+    _epoch_us,
+    _group_key,
+    _notify_state_changed,
+)
+
+EXPORT_FORMAT = "fie_lonet_switch"
+EXPORT_FORMAT_VERSION = 1
+
+# Rows written per executemany on import.
+DEFAULT_IMPORT_BATCH_SIZE = 1000
+
+_SWITCH_STATE_CHANGE_FIELDS = SwitchStateChangeRow._fields
+_JINJA_TEMPLATE_FIELDS = JinjaTemplateRow._fields
+
+# The row type of each record type, and the statements that import it in replace and merge mode.
+_IMPORT_STATEMENTS: Dict[str, Tuple[Tuple[str, ...], str, str]] = {
+    "history": (
+        _SWITCH_STATE_CHANGE_FIELDS,
+        '''
+            INSERT INTO switch_state_change (id, c_time, mode, group_name, locale, seq, c_epoch_us)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        # Changes already known by id are kept as they are.
+        '''
+            INSERT OR IGNORE INTO switch_state_change (id, c_time, mode, group_name, locale, seq, c_epoch_us)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+    ),
+    "current_state": (
+        _SWITCH_STATE_CHANGE_FIELDS,
+        '''
+            INSERT INTO current_state (id, c_time, mode, group_name, locale, seq, c_epoch_us)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        # The newer of the local and the imported state of a group wins.
+        '''
+            INSERT INTO current_state (id, c_time, mode, group_name, locale, seq, c_epoch_us)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (group_name) DO UPDATE SET
+                id = excluded.id, c_time = excluded.c_time, mode = excluded.mode, locale = excluded.locale,
+                seq = excluded.seq, c_epoch_us = excluded.c_epoch_us
+            WHERE excluded.c_epoch_us > current_state.c_epoch_us
+        ''',
+    ),
+    "template": (
+        _JINJA_TEMPLATE_FIELDS,
+        '''
+            INSERT INTO jinja_templates (id, path, group_name, group_key)
+            VALUES (?, ?, ?, ?)
+        ''',
+        # Templates already registered by id or path keep their local group.
+        '''
+            INSERT OR IGNORE INTO jinja_templates (id, path, group_name, group_key)
+            VALUES (?, ?, ?, ?)
+        ''',
+    ),
+}
+
+
+def export_records(db: SwitchStateDB) -> Iterator[Dict[str, str]]:
+    """
+    Yield the export records of a database, header first.  All rows are read in one read
+    transaction on a connection of their own.  In WAL mode that transaction sees a consistent
+    snapshot of the database, and other processes can keep switching while the export is
+    written out.
+    Args:
+        db (SwitchStateDB): The database to export.
+    Returns:
+        Iterator[Dict[str, str]]: The records, as written one per line by export_jsonl().
+    """
+    # An in-memory database cannot be opened twice; nothing else can write to it anyway.
+    snapshot = db.conn if db.db_path == ":memory:" else sqlite3.connect(db.db_path, timeout=DEFAULT_BUSY_TIMEOUT)
+    try:
+        if snapshot is not db.conn:
+            snapshot.execute('BEGIN')
+        yield {
+            "type": "header",
+            "format": EXPORT_FORMAT,
+            "v": EXPORT_FORMAT_VERSION,
+            "schema_version": SCHEMA_VERSION,
+            "exported": datetime.now().isoformat(),
+        }
+        queries = (
+            ("history", _SWITCH_STATE_CHANGE_FIELDS,
+             'SELECT id, c_time, mode, group_name, locale, seq, c_epoch_us FROM switch_state_change ORDER BY seq'),
+            ("current_state", _SWITCH_STATE_CHANGE_FIELDS,
+             'SELECT id, c_time, mode, group_name, locale, seq, c_epoch_us FROM current_state ORDER BY group_name'),
+            ("template", _JINJA_TEMPLATE_FIELDS,
+             'SELECT id, path, group_name FROM jinja_templates ORDER BY rowid'),
+        )
+        for record_type, fields, query in queries:
+            for row in snapshot.execute(query):
+                record = {"type": record_type}
+                record.update(zip(fields, row))
+                yield record
+    finally:
+        if snapshot is not db.conn:
+            snapshot.rollback()
+            snapshot.close()
+
+
+def export_jsonl(db: SwitchStateDB, output) -> Dict[str, int]:
+    """
+    Write an export of a database to a text file as JSON lines.
+    Args:
+        db (SwitchStateDB): The database to export.
+        output: A text file open for writing.
+    Returns:
+        Dict[str, int]: The number of exported rows by record type.
+    """
+    counts = {record_type: 0 for record_type in _IMPORT_STATEMENTS}
+    for record in export_records(db):
+        output.write(json.dumps(record) + "\n")
+        if record["type"] in counts:
+            counts[record["type"]] += 1
+    return counts
+
+
+def import_jsonl(
+    db: SwitchStateDB,
+    lines: Iterable[str],
+    mode: Literal["merge", "replace"] = "merge",
+    batch_size: int = DEFAULT_IMPORT_BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    Import an export made by export_jsonl() in a single transaction.
+
+    In replace mode the history, current state and templates of the database are replaced by
+    the imported ones.  In merge mode the imported rows are added: history and templates that
+    already exist (by id, or by path for templates) are kept, and each group's current state
+    becomes the newer of the local and the imported one.  As with switching, the newest "*"
+    change then clears every change made before it, local or imported.
+
+    Args:
+        db (SwitchStateDB): The database to import into.
+        lines (Iterable[str]): The JSON lines, e.g. an open file.
+        mode (Literal["merge", "replace"]): How to combine the import with existing data.
+        batch_size (int): Rows written per executemany.
+    Returns:
+        Dict[str, int]: The number of rows written by record type.  Rows ignored in merge mode
+            are not counted.
+    """
+    if mode not in ("merge", "replace"):
+        raise ValueError(f"Unknown import mode '{mode}'.")
+    statement_index = 1 if mode == "replace" else 2
+    counts = {record_type: 0 for record_type in _IMPORT_STATEMENTS}
+    batches: Dict[str, List[Tuple[str, ...]]] = {record_type: [] for record_type in _IMPORT_STATEMENTS}
+
+    def flush(record_type: str) -> None:
+        cur = db.conn.cursor()
+        cur.executemany(_IMPORT_STATEMENTS[record_type][statement_index], batches[record_type])
+        counts[record_type] += cur.rowcount
+        batches[record_type] = []
+
+    records = _parse_records(lines)
+    db.begin(immediate=True)
+    try:
+        if mode == "replace":
+            db.clear_switch_state_changes()
+            db.clear_current_state()
+            db.conn.execute('DELETE FROM jinja_templates')
+        for record_type, row in records:
+            batches[record_type].append(row)
+            if len(batches[record_type]) >= batch_size:
+                flush(record_type)
+        for record_type in batches:
+            if batches[record_type]:
+                flush(record_type)
+        db.resequence_switch_state_changes(by_time=mode == "merge")
+        # A merged "*" change clears the changes made before it, as when switching.
+        db.clear_switch_state_changes_before_all()
+        db.recount_switch_state_changes()
+        db.commit()
+    except sqlite3.IntegrityError as e:
+        db.rollback()
+        raise ValueError(f"Import conflicts with itself or the database: {e}") from e
+    except Exception as e:
+        db.rollback()
+        raise e
+    _notify_state_changed(db)
+    return counts
+
+
+def _parse_records(lines: Iterable[str]) -> Iterator[Tuple[str, Tuple[Any, ...]]]:
+    """Parse and check export lines, yielding (record type, row values) after the header."""
+    header_seen = False
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {number}: invalid JSON: {e}") from e
+        record_type = record.get("type") if isinstance(record, dict) else None
+        if not header_seen:
+            if record_type != "header" or record.get("format") != EXPORT_FORMAT:
+                raise ValueError(f"Line {number}: not a {EXPORT_FORMAT} export.")
+            if record.get("v") != EXPORT_FORMAT_VERSION:
+                raise ValueError(f"Line {number}: unknown export format version {record.get('v')!r}.")
+            header_seen = True
+            continue
+        if record_type not in _IMPORT_STATEMENTS:
+            raise ValueError(f"Line {number}: unknown record type {record_type!r}.")
+        fields = _IMPORT_STATEMENTS[record_type][0]
+        if fields is _SWITCH_STATE_CHANGE_FIELDS:
+            yield record_type, _parse_switch_state_change(number, record)
+            continue
+        try:
+            row = tuple(str(record[field]) for field in fields)
+        except KeyError as e:
+            raise ValueError(f"Line {number}: {record_type} record lacks {e}.") from e
+        # Only templates are left, stored with the key their group is matched by.
+        yield record_type, row + (_group_key(row[2]),)
+    if not header_seen:
+        raise ValueError("The import is empty.")
+
+
+def _parse_switch_state_change(number: int, record: Dict[str, Any]) -> Tuple[Any, ...]:
+    try:
+        row = [str(record[field]) for field in _SWITCH_STATE_CHANGE_FIELDS[:5]]
+    except KeyError as e:
+        raise ValueError(f"Line {number}: {record['type']} record lacks {e}.") from e
+    if record["mode"] not in ("lo", "net"):
+        raise ValueError(f"Line {number}: invalid mode {record['mode']!r}.")
+    seq, c_epoch_us = record.get("seq"), record.get("c_epoch_us")
+    try:
+        row.append(None if seq is None else int(seq))
+        row.append(_epoch_us(row[1]) if c_epoch_us is None else int(c_epoch_us))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Line {number}: invalid time or sequence number: {e}") from e
+    return tuple(row)
@@ -1,12 +1,11 @@
+import contextlib
+import sys
+
 import click
-from fie_lonet_switch.switcher import do_switch
-from fie_lonet_switch.database import (
-    SwitchStateDB,
-    get_switch_state_transaction,
-    compact_db_transaction,
-    clear_group_transaction,
-    JinjaTemplate,
-)
+from fie_lonet_switch.config import DEFAULT_HOOK_WORKERS, DEFAULT_RENDER_WORKERS
+
+# Commands import what they need when they run.  Read-only commands such as status are
+# called from shell prompts and scripts, so they must not pay for pydantic or jinja2.
 
 
 def _resolve_group_alias(group: str) -> str:
@@ -15,6 +14,72 @@ def _resolve_group_alias(group: str) -> str:
         return "*"
     return group
 
+@contextlib.contextmanager
+def _profiling(profile: bool, profile_stats):
+    """Record timing spans (printed to stderr as JSON) and/or cProfile stats for the body."""
+    if not profile and profile_stats is None:
+        yield
+        return
+    from fie_lonet_switch.metrics import SpanRecorder
+
+    profiler = None
+    if profile_stats is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+    try:
+        with SpanRecorder() as recorder:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile_stats)
+        if profile:
+            import json
+
+            click.echo(json.dumps(recorder.to_dict(), indent=2), err=True)
+
+_profile_options = [
+    click.option('--profile', is_flag=True, default=False,
+                 help='Print a JSON breakdown of where the time went to stderr.'),
+    click.option('--profile-stats', type=click.Path(dir_okay=False, writable=True), default=None,
+                 help='Write cProfile stats to this file (read them with python -m pstats). Only the calling '
+                      'thread is profiled; use --render-workers 1 --hook-workers 1 to include templates and scripts.'),
+]
+
+def _add_profile_options(command):
+    for option in reversed(_profile_options):
+        command = option(command)
+    return command
+
+# Options of the commands that render templates and run switch scripts.
+_side_effect_options = [
+    click.option('--render-workers', type=click.IntRange(min=1), default=DEFAULT_RENDER_WORKERS, show_default=True,
+                 help='Number of jinja templates rendered at once.'),
+    click.option('--template-timeout', type=float, default=None,
+                 help='Seconds each jinja template may take to render.'),
+    click.option('--hook-workers', type=click.IntRange(min=1), default=DEFAULT_HOOK_WORKERS, show_default=True,
+                 help='Number of homedir switch scripts run at once.'),
+    click.option('--hook-timeout', type=float, default=None,
+                 help='Seconds each homedir switch script may run.'),
+    click.option('--force', is_flag=True, default=False,
+                 help='Render templates and run switch scripts even if the state did not change.'),
+]
+
+def _add_side_effect_options(command):
+    for option in reversed(_side_effect_options):
+        command = option(command)
+    return command
+
+_async_option = click.option('--async', 'run_async', is_flag=True, default=False,
+                             help='Return once the switch is committed and render templates and run scripts in '
+                                  'the background (see the jobs command).')
+
 @click.group()
 def main():
     """FIE LO/NET Switch CLI."""
@@ -24,29 +89,120 @@ def main():
 @click.argument('switch_to', type=click.Choice(['lo', 'net']))
 @click.argument('group', required=False, default='*')
 @click.argument('locale', required=False, default='')
-def switch(switch_to, group, locale):
+@_add_side_effect_options
+@_async_option
+@_add_profile_options
+def switch(switch_to, group, locale, render_workers, template_timeout, hook_workers, hook_timeout, run_async,
+           force, profile, profile_stats):
     """Switch the state to 'lo' or 'net'. Optionally specify group and locale.
     The group name ``all`` may be used as an alias for ``*``.
     """
+    from fie_lonet_switch.switcher import do_switch
+
     group = _resolve_group_alias(group)
-    do_switch(switch_to, group, locale)
+    with _profiling(profile, profile_stats):
+        do_switch(switch_to, group, locale, render_workers, template_timeout, hook_workers, hook_timeout,
+                  background="process" if run_async else None, force=force)
     click.echo(f"Switched to {switch_to} (group: {group}, locale: {locale})")
 
+def _parse_switch_spec(text: str):
+    """Parse a ``group=mode[:locale]`` switch spec."""
+    from fie_lonet_switch.database import SwitchSpec
+
+    group, sep, rest = text.strip().partition('=')
+    mode, _, locale = rest.partition(':')
+    if not sep or not group or mode not in ('lo', 'net'):
+        raise click.BadParameter(f"'{text}' is not of the form group=lo|net[:locale]")
+    return SwitchSpec(mode, _resolve_group_alias(group), locale)
+
+@main.command()
+@click.argument('specs', nargs=-1)
+@click.option('--file', '-f', 'spec_file', type=click.File('r'), default=None,
+              help='Read additional specs from a file, one per line ("-" for stdin). Lines starting with # are ignored.')
+@_add_side_effect_options
+@_async_option
+@_add_profile_options
+def batch(specs, spec_file, render_workers, template_timeout, hook_workers, hook_timeout, run_async,
+          force, profile, profile_stats):
+    """Switch several groups at once. Each SPEC is ``group=lo|net[:locale]``,
+    e.g. ``batch all=lo work=net:us-east``. All switches are committed together,
+    then templates are rendered and switch scripts run once for all of them.
+    """
+    texts = list(specs)
+    if spec_file is not None:
+        texts.extend(line for line in (raw.strip() for raw in spec_file) if line and not line.startswith('#'))
+    if not texts:
+        raise click.UsageError("No switch specs given.")
+    parsed = [_parse_switch_spec(text) for text in texts]
+
+    from fie_lonet_switch.switcher import do_switch_batch
+
+    with _profiling(profile, profile_stats):
+        do_switch_batch(parsed, render_workers, template_timeout, hook_workers, hook_timeout,
+                        background="process" if run_async else None, force=force)
+    click.echo(f"Switched {len(parsed)} group(s): " + ", ".join(
+        f"{spec.group}={spec.mode}" + (f":{spec.locale}" if spec.locale else "") for spec in parsed
+    ))
+
 @main.command()
 @click.argument('group', required=False, default='*')
 def status(group):
     """Show the current switch state for a group (default: all). The group name
     ``all`` may be used as an alias for ``*``.
     """
+    from fie_lonet_switch.database import SwitchStateDB, get_switch_state_transaction
+
     group = _resolve_group_alias(group)
     db = SwitchStateDB()
     state, locale = get_switch_state_transaction(db, group)
     db.close()
     click.echo(f"Current state for group '{group}': {state} (locale: {locale})")
 
+@main.command()
+@click.option('--group', '-g', default=None, help='Only changes of this group.')
+@click.option('--mode', type=click.Choice(['lo', 'net']), default=None, help='Only changes to this mode.')
+@click.option('--locale', default=None, help='Only changes to this locale.')
+@click.option('--since', type=click.DateTime(), default=None, help='Only changes made at or after this time.')
+@click.option('--until', type=click.DateTime(), default=None, help='Only changes made before this time.')
+@click.option('--newest-first', is_flag=True, default=False, help='List the newest changes first.')
+@click.option('--limit', type=click.IntRange(min=1), default=None, help='Stop after this many changes.')
+@click.option('--format', 'output_format', type=click.Choice(['table', 'jsonl', 'csv']), default='table',
+              show_default=True, help='Output format.')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Write to a file instead of stdout.')
+def history(group, mode, locale, since, until, newest_first, limit, output_format, output):
+    """Show or export the switch history, oldest change first. The history is
+    streamed, so it can be exported however long it is. The group name ``all``
+    may be used as an alias for ``*``.
+    """
+    import itertools
+    from fie_lonet_switch.database import SwitchStateChangeRow, SwitchStateDB
+
+    if group is not None:
+        group = _resolve_group_alias(group)
+    with SwitchStateDB() as db:
+        rows = db.iter_switch_state_changes(group, mode, locale, since, until, newest_first)
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+        if output_format == 'jsonl':
+            import json
+
+            for row in rows:
+                output.write(json.dumps(row._asdict()) + '\n')
+        elif output_format == 'csv':
+            import csv
+
+            writer = csv.writer(output)
+            writer.writerow(SwitchStateChangeRow._fields)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                output.write(f"{row.c_time} | Group: {row.group} | State: {row.mode} | Locale: {row.locale}\n")
+
 @main.command()
 def compact():
     """Compact the switch state database to save space (keeps only the latest state per group)."""
+    from fie_lonet_switch.database import SwitchStateDB, compact_db_transaction
+
     db = SwitchStateDB()
     try:
         compact_db_transaction(db)
@@ -56,18 +212,83 @@ def compact():
     finally:
         db.close()
 
+@main.group()
+def retention():
+    """Manage the switch state history retention policy. The policy is applied
+    automatically once the history grows past its threshold.
+    """
+    pass
+
+
+@retention.command("show")
+def show_retention():
+    """Show the retention policy and the size of the history."""
+    from fie_lonet_switch.database import SwitchStateDB
+
+    with SwitchStateDB() as db:
+        policy = db.get_retention_policy()
+        count = db.count_switch_state_changes()
+    click.echo(f"Keep last: {policy.keep_last or 'all'} changes per group")
+    click.echo(f"Max age: {f'{policy.max_age_days:g} days' if policy.max_age_days else 'unlimited'}")
+    click.echo(f"Threshold: {policy.threshold or 'never applied automatically'}")
+    click.echo(f"History: {count} changes")
+
+
+@retention.command("set")
+@click.option('--keep-last', type=click.IntRange(min=0), default=None,
+              help='Changes kept per group. 0 keeps all of them.')
+@click.option('--max-age-days', type=click.FloatRange(min=0), default=None,
+              help='Remove changes older than this. 0 disables the age limit.')
+@click.option('--threshold', type=click.IntRange(min=0), default=None,
+              help='Apply the policy automatically once history grows past this many changes. 0 disables that.')
+def set_retention(keep_last, max_age_days, threshold):
+    """Change the retention policy. Options that are not given keep their value."""
+    from fie_lonet_switch.database import SwitchStateDB
+
+    db = SwitchStateDB()
+    try:
+        db.begin(immediate=True)
+        policy = db.get_retention_policy()
+        updates = {'keep_last': keep_last, 'max_age_days': max_age_days, 'threshold': threshold}
+        policy = policy._replace(**{key: value for key, value in updates.items() if value is not None})
+        db.set_retention_policy(policy)
+        db.commit()
+        click.echo(f"Retention policy: keep last {policy.keep_last}, max age {policy.max_age_days:g} days, "
+                   f"threshold {policy.threshold}")
+    except Exception as e:
+        db.rollback()
+        click.echo(f"Error setting retention policy: {e}")
+    finally:
+        db.close()
+
+
+@retention.command("apply")
+def apply_retention():
+    """Apply the retention policy now."""
+    from fie_lonet_switch.database import SwitchStateDB, retention_transaction
+
+    db = SwitchStateDB()
+    try:
+        deleted = retention_transaction(db)
+        click.echo(f"Deleted {deleted} switch state changes.")
+    except Exception as e:
+        click.echo(f"Error applying retention policy: {e}")
+    finally:
+        db.close()
+
 @main.command()
 def list_all():
     """List all groups and their current switch states."""
+    from fie_lonet_switch.database import SwitchStateDB
+
     db = SwitchStateDB()
     try:
-        groups = db.get_all_groups()
-        if not groups:
+        states = db.get_all_resolved_states()
+        if not states:
             click.echo("No groups found in the database.")
             return
-        for group in groups:
-            state, locale = get_switch_state_transaction(db, group)
-            click.echo(f"Group: {group} | State: {state} | Locale: {locale}")
+        for state in states:
+            click.echo(f"Group: {state.group} | State: {state.mode} | Locale: {state.locale}")
     except Exception as e:
         click.echo(f"Error listing groups: {e}")
     finally:
@@ -79,6 +300,8 @@ def clear_group(group):
     """Delete all switch state changes for a given group. The group name ``all``
     may be used as an alias for ``*``.
     """
+    from fie_lonet_switch.database import SwitchStateDB, clear_group_transaction
+
     group = _resolve_group_alias(group)
     db = SwitchStateDB()
     try:
@@ -89,6 +312,133 @@ def clear_group(group):
     finally:
         db.close()
 
+@main.command()
+def snapshot():
+    """Write the snapshot file of resolved states now. It is rewritten after every
+    switch anyway; use this to create it for an existing database.
+    """
+    from fie_lonet_switch.database import SwitchStateDB, write_state_snapshot_transaction
+    from fie_lonet_switch.snapshot import snapshot_path_for_db
+
+    with SwitchStateDB() as db:
+        write_state_snapshot_transaction(db)
+        click.echo(f"Snapshot written to {snapshot_path_for_db(db.db_path)}")
+
+@main.command()
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Write to a file instead of stdout.')
+def export(output):
+    """Export the switch history, current state and templates as JSON lines. The
+    export is a consistent snapshot, even while other tools switch.
+    """
+    from fie_lonet_switch.backup import export_jsonl
+    from fie_lonet_switch.database import SwitchStateDB
+
+    with SwitchStateDB() as db:
+        counts = export_jsonl(db, output)
+    click.echo(f"Exported {counts['history']} changes, {counts['current_state']} current states "
+               f"and {counts['template']} templates.", err=True)
+
+@main.command('import')
+@click.argument('input_file', type=click.File('r'), default='-')
+@click.option('--mode', type=click.Choice(['merge', 'replace']), default='merge', show_default=True,
+              help='Add to the existing data, or replace it.')
+def import_(input_file, mode):
+    """Import an export made with the export command (from stdin by default).
+    The import is applied in a single transaction: if it fails, nothing changes.
+    """
+    from fie_lonet_switch.backup import import_jsonl
+    from fie_lonet_switch.database import SwitchStateDB
+
+    with SwitchStateDB() as db:
+        try:
+            counts = import_jsonl(db, input_file, mode)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"Imported {counts['history']} changes, {counts['current_state']} current states "
+               f"and {counts['template']} templates.")
+
+@main.command()
+def daemon():
+    """Run the user daemon in the foreground. It serves the resolved switch state
+    from memory on localhost for 3rd party tools (see user_daemon.port and
+    user_daemon.key in the configuration directory).
+    """
+    from fie_lonet_switch.user_daemon import UserDaemon
+
+    user_daemon = UserDaemon()
+    click.echo(f"User daemon listening on 127.0.0.1:{user_daemon.port}")
+    try:
+        user_daemon.serve_forever()
+    except KeyboardInterrupt:
+        click.echo("User daemon stopped.")
+
+@main.command()
+@click.option('--group', '-g', 'groups', multiple=True,
+              help='Only report changes of this group. May be given several times.')
+@click.option('--initial', is_flag=True, default=False,
+              help='Start by reporting the current state of every group.')
+@click.option('--interval', type=click.FloatRange(min=0.01), default=0.1, show_default=True,
+              help='Seconds between checks for new commits.')
+def watch(groups, initial, interval):
+    """Report switch state changes as they happen, one JSON object per line with
+    the group, mode, locale and timestamp of the change. Runs until interrupted.
+    """
+    import json
+    from fie_lonet_switch.watch import subscribe
+
+    groups = {_resolve_group_alias(group) for group in groups}
+    try:
+        for event in subscribe(poll_interval=interval, initial=initial):
+            if not groups or event.group in groups:
+                click.echo(json.dumps(event.to_dict()))
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+@main.group(invoke_without_command=True)
+@click.option('--status', type=click.Choice(['pending', 'running', 'done', 'failed']), default=None,
+              help='Only list jobs with this status.')
+@click.option('--limit', type=click.IntRange(min=1), default=20, show_default=True,
+              help='Number of jobs listed, newest first.')
+@click.pass_context
+def jobs(ctx, status, limit):
+    """List the side effect jobs of background (--async) switches."""
+    if ctx.invoked_subcommand is not None:
+        return
+    from fie_lonet_switch.database import SwitchStateDB
+
+    with SwitchStateDB() as db:
+        found = db.get_side_effect_jobs(status, limit)
+    if not found:
+        click.echo("No jobs found.")
+    for job in found:
+        specs = ", ".join(f"{spec.group}={spec.mode}" + (f":{spec.locale}" if spec.locale else "") for spec in job.specs)
+        click.echo(f"{job.id} {job.status:<7} {job.c_time} {specs}" + (f" | {job.detail}" if job.detail else ""))
+
+
+@jobs.command("run")
+@click.argument('job_id', required=False)
+@_add_side_effect_options
+def run_jobs(job_id, render_workers, template_timeout, hook_workers, hook_timeout, force):
+    """Run a pending side effect job, or all pending jobs oldest first if no JOB_ID is given."""
+    from fie_lonet_switch.database import get_shared_db
+    from fie_lonet_switch.switcher import run_side_effect_job
+
+    db = get_shared_db()
+    if job_id is None:
+        job_ids = [job.id for job in reversed(db.get_side_effect_jobs('pending', limit=-1))]
+        if not job_ids:
+            click.echo("No pending jobs.")
+    else:
+        job_ids = [job_id]
+    for pending_id in job_ids:
+        try:
+            ran = run_side_effect_job(pending_id, db, render_workers, template_timeout, hook_workers, hook_timeout, force)
+        except LookupError as e:
+            raise click.ClickException(str(e))
+        job = db.get_side_effect_job(pending_id)
+        click.echo(f"Job {pending_id}: {job.status}" + ("" if ran else " (not pending, not run)"))
+
 @main.group()
 def jinjas():
     """Manage jinja template paths."""
@@ -98,6 +448,8 @@ def jinjas():
 @jinjas.command("list")
 def list_jinjas():
     """List the stored jinja template paths."""
+    from fie_lonet_switch.database import SwitchStateDB
+
     db = SwitchStateDB()
     try:
         templates = db.get_all_jinja_templates()
@@ -114,6 +466,8 @@ def add_jinja(path, group):
     """Add a jinja template path. The group name ``all`` may be used as an
     alias for ``*``.
     """
+    from fie_lonet_switch.database import SwitchStateDB, JinjaTemplate
+
     group = _resolve_group_alias(group)
     db = SwitchStateDB()
     try:
@@ -138,6 +492,8 @@ def add_jinja(path, group):
 @click.argument("path")
 def delete_jinja(path):
     """Remove a jinja template path."""
+    from fie_lonet_switch.database import SwitchStateDB
+
     db = SwitchStateDB()
     try:
         db.begin()
@@ -0,0 +1,23 @@
+from pathlib import Path
+
+# Number of jinja templates rendered at once during a switch.  Rendering is mostly file I/O,
+# so threads help even for a handful of templates, especially on network mounted paths.
+DEFAULT_RENDER_WORKERS = 4
+
+# Number of homedir switch scripts (hooks) run at once during a switch.  Hooks usually wait on
+# the network or other processes, so a slow one should not hold up the rest.
+DEFAULT_HOOK_WORKERS = 4
+
+
+def get_config_dir(create: bool = True) -> Path:
+    """
+    Get the user's configuration directory (usually ~/.fie_lonet_switch).
+    Args:
+        create (bool): Create the directory if it does not exist yet.
+    Returns:
+        Path: The configuration directory.
+    """
+    config_dir = Path.home() / ".fie_lonet_switch"
+    if create:
+        config_dir.mkdir(parents=True, exist_ok=True)
+    return config_dir
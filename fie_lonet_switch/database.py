@@ -1,40 +1,289 @@
-import os
+import json
 import sqlite3
-from pathlib import Path
-from pydantic import BaseModel, Field, validator
-from typing import Optional, List, Dict, Any, Union, Tuple, Literal
+import threading
+from typing import Optional, List, Dict, Any, Union, Tuple, Literal, NamedTuple, Callable, Iterable, Iterator, TYPE_CHECKING
 import uuid
-from datetime import datetime
-
-class SwitchStateChange(BaseModel):
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, description="Unique identifier for the state change event.")
-    c_time: datetime = Field(default_factory=datetime.utcnow, description="Creation time (UTC) of the state change event.")
-    mode: Literal["lo", "net"] = Field(..., description="Switch mode: 'lo' for local, 'net' for network.")
-    group: str = Field(default="*", description="Group name for the switch event.")
-    locale: str = Field(default="", description="Locale for the switch event.")
-
-class JinjaTemplate(BaseModel):
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, description="Unique identifier for the template.")
-    path: str = Field(..., description="Path to .jinja template file")
-    group: str = Field(default="*", description="Group associated with this template.")
-
-    @validator('path')
-    def _validate_path(cls, v: str) -> str:
-        if not v.endswith('.jinja'):
-            raise ValueError('path must end with .jinja')
-        return v
+from datetime import datetime, timedelta
+from fie_lonet_switch.config import get_config_dir
+
+if TYPE_CHECKING:
+    from fie_lonet_switch.models import SwitchStateChange, JinjaTemplate
+
+def __getattr__(name: str) -> Any:
+    # The pydantic models are only imported when first used, so read-only commands
+    # do not pay for importing pydantic.
+    if name in ("SwitchStateChange", "JinjaTemplate"):
+        from fie_lonet_switch import models
+        return getattr(models, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class CurrentState(NamedTuple):
+    """A group's own latest change as stored in current_state. A lightweight read row."""
+    group: str
+    mode: str
+    locale: str
+    c_time: str
+    # The change's position in switch order, see SwitchStateChangeRow.seq.
+    seq: int = 0
+
+class SwitchStateChangeRow(NamedTuple):
+    """A switch_state_change row as stored. A lightweight alternative to the SwitchStateChange model."""
+    id: str
+    c_time: str
+    mode: str
+    group: str
+    locale: str
+    # The position of the change in switch order.  Sequence numbers come from a counter that
+    # only ever goes up, so unlike c_time they order changes correctly even when they are made
+    # in the same microsecond or the clock is changed.  None lets the database assign one.
+    seq: Optional[int] = None
+    # c_time as microseconds since the Unix epoch.  None lets the database compute it.
+    c_epoch_us: Optional[int] = None
+
+class JinjaTemplateRow(NamedTuple):
+    """A jinja_templates row as stored. A lightweight alternative to the JinjaTemplate model."""
+    id: str
+    path: str
+    group: str
+
+class ResolvedState(NamedTuple):
+    """The effective switch state of a group after applying the "*" override."""
+    group: str
+    mode: str
+    locale: str
+    c_time: str
+
+class SwitchSpec(NamedTuple):
+    """A requested switch of a group to a mode and locale."""
+    mode: str
+    group: str = "*"
+    locale: str = ""
+
+class RetentionPolicy(NamedTuple):
+    """How much switch_state_change history is kept. The current state of a group is always kept."""
+    # Changes kept per group. 0 keeps all of them.
+    keep_last: int = 100
+    # Changes older than this many days are removed. 0 disables the age limit.
+    max_age_days: float = 0
+    # The policy is applied automatically once history grows past this many rows. 0 disables that.
+    threshold: int = 10000
+
+class SideEffectJob(NamedTuple):
+    """A queued run of a switch's side effects (template rendering and homedir switch scripts)."""
+    id: str
+    c_time: str
+    status: str  # "pending", "running", "done" or "failed"
+    specs: List[SwitchSpec]
+    started: Optional[str]
+    finished: Optional[str]
+    detail: str
+
+def _migration_1_indexes(cur: sqlite3.Cursor) -> None:
+    """Index the per-group history lookups and template group filtering."""
+    # Databases created before templates had groups lack the group_name column.
+    cur.execute("PRAGMA table_info(jinja_templates)")
+    cols = [row[1] for row in cur.fetchall()]
+    if 'group_name' not in cols:
+        cur.execute('ALTER TABLE jinja_templates ADD COLUMN group_name TEXT NOT NULL DEFAULT "*"')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_switch_state_change_group_c_time
+        ON switch_state_change (group_name, c_time)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jinja_templates_group_name
+        ON jinja_templates (group_name)
+    ''')
+
+def _migration_2_current_state(cur: sqlite3.Cursor) -> None:
+    """Materialize the latest change of every group into current_state."""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS current_state (
+            group_name TEXT PRIMARY KEY,
+            id TEXT NOT NULL,
+            c_time TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            locale TEXT NOT NULL
+        )
+    ''')
+    cur.execute('DELETE FROM current_state')
+    cur.execute('''
+        INSERT INTO current_state (group_name, id, c_time, mode, locale)
+        SELECT group_name, id, c_time, mode, locale FROM (
+            SELECT group_name, id, c_time, mode, locale,
+                   ROW_NUMBER() OVER (PARTITION BY group_name ORDER BY c_time DESC) AS rn
+            FROM switch_state_change
+        )
+        WHERE rn = 1
+    ''')
+
+# Rebuilds current_state from the latest switch_state_change row of every group.
+_INSERT_CURRENT_STATE_FROM_HISTORY = '''
+    INSERT INTO current_state (group_name, id, c_time, mode, locale, seq, c_epoch_us)
+    SELECT group_name, id, c_time, mode, locale, seq, c_epoch_us FROM (
+        SELECT group_name, id, c_time, mode, locale, seq, c_epoch_us,
+               ROW_NUMBER() OVER (PARTITION BY group_name ORDER BY seq DESC) AS rn
+        FROM switch_state_change
+    )
+    WHERE rn = 1
+'''
+
+def _migration_3_settings(cur: sqlite3.Cursor) -> None:
+    """Add a key/value table for user settings such as the retention policy."""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+def _migration_4_side_effect_jobs(cur: sqlite3.Cursor) -> None:
+    """Add a table recording side effect runs of switches made in the background."""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS side_effect_jobs (
+            id TEXT PRIMARY KEY,
+            c_time TEXT NOT NULL,
+            status TEXT NOT NULL,
+            specs TEXT NOT NULL,
+            started TEXT,
+            finished TEXT,
+            detail TEXT NOT NULL DEFAULT ''
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_side_effect_jobs_c_time
+        ON side_effect_jobs (c_time)
+    ''')
+
+def _migration_5_history_keyset_indexes(cur: sqlite3.Cursor) -> None:
+    """Index history in (c_time, id) order, overall and per group, for keyset pagination."""
+    cur.execute('DROP INDEX IF EXISTS idx_switch_state_change_group_c_time')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_switch_state_change_group_c_time_id
+        ON switch_state_change (group_name, c_time, id)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_switch_state_change_c_time_id
+        ON switch_state_change (c_time, id)
+    ''')
+
+def _migration_6_jinja_templates_group_nocase(cur: sqlite3.Cursor) -> None:
+    """Index template groups case-insensitively, the way templates are matched to switches."""
+    cur.execute('DROP INDEX IF EXISTS idx_jinja_templates_group_name')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jinja_templates_group_name_nocase
+        ON jinja_templates (group_name COLLATE NOCASE)
+    ''')
+
+def _migration_7_switch_sequence(cur: sqlite3.Cursor) -> None:
+    """
+    Order changes by a sequence number instead of their c_time text, and store c_time as an
+    integer epoch time.  Existing changes are numbered in c_time order, together with current
+    states whose change is no longer in the history (the CRUD methods can leave those behind).
+    """
+    for table in ('switch_state_change', 'current_state'):
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN seq INTEGER')
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN c_epoch_us INTEGER')
+    cur.execute('''
+        SELECT c_time, id, 'switch_state_change' FROM switch_state_change
+        UNION ALL
+        SELECT c_time, id, 'current_state' FROM current_state
+        WHERE id NOT IN (SELECT id FROM switch_state_change)
+        ORDER BY 1, 2
+    ''')
+    rows = cur.fetchall()
+    for table in ('switch_state_change', 'current_state'):
+        cur.executemany(
+            f'UPDATE {table} SET seq = ?, c_epoch_us = ? WHERE id = ?',
+            (
+                (seq, _epoch_us(c_time), id)
+                for seq, (c_time, id, row_table) in enumerate(rows, start=1) if row_table == table
+            ),
+        )
+    cur.execute('''
+        UPDATE current_state SET
+            seq = (SELECT seq FROM switch_state_change AS h WHERE h.id = current_state.id),
+            c_epoch_us = (SELECT c_epoch_us FROM switch_state_change AS h WHERE h.id = current_state.id)
+        WHERE id IN (SELECT id FROM switch_state_change)
+    ''')
+    cur.execute(
+        "INSERT OR REPLACE INTO settings (key, value) VALUES ('switch.last_seq', ?)", (str(len(rows)),)
+    )
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_switch_state_change_group_seq
+        ON switch_state_change (group_name, seq)
+    ''')
+
+def _migration_8_jinja_templates_group_key(cur: sqlite3.Cursor) -> None:
+    """
+    Match template groups by a lowercased copy of their name instead of NOCASE, which only
+    folds ASCII letters ("Über" did not match "über").  See _group_key().
+    """
+    cur.execute('ALTER TABLE jinja_templates ADD COLUMN group_key TEXT')
+    cur.execute('SELECT id, group_name FROM jinja_templates')
+    cur.executemany(
+        'UPDATE jinja_templates SET group_key = ? WHERE id = ?',
+        [(_group_key(group), id) for id, group in cur.fetchall()],
+    )
+    cur.execute('DROP INDEX IF EXISTS idx_jinja_templates_group_name_nocase')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jinja_templates_group_key
+        ON jinja_templates (group_key)
+    ''')
+
+def _migration_9_history_count(cur: sqlite3.Cursor) -> None:
+    """Count the history rows in settings, so switches need not count them to apply retention."""
+    cur.execute(
+        "INSERT OR REPLACE INTO settings (key, value) "
+        "SELECT 'history.count', COUNT(*) FROM switch_state_change"
+    )
+
+# Schema migrations, applied in order.  Migration N upgrades a database from
+# PRAGMA user_version N-1 to N.  Only ever append to this list.
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _migration_1_indexes,
+    _migration_2_current_state,
+    _migration_3_settings,
+    _migration_4_side_effect_jobs,
+    _migration_5_history_keyset_indexes,
+    _migration_6_jinja_templates_group_nocase,
+    _migration_7_switch_sequence,
+    _migration_8_jinja_templates_group_key,
+    _migration_9_history_count,
+]
+
+# Finished side effect jobs kept in side_effect_jobs.
+SIDE_EFFECT_JOBS_KEPT = 100
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Seconds a connection waits for another process's lock before raising "database is locked".
+DEFAULT_BUSY_TIMEOUT = 5.0
 
 class SwitchStateDB:
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, busy_timeout: float = DEFAULT_BUSY_TIMEOUT):
         if db_path is None:
-            config_dir = Path.home() / ".fie_lonet_switch"
-            config_dir.mkdir(parents=True, exist_ok=True)
-            db_path = config_dir / "switch_state.sql"
+            db_path = get_config_dir() / "switch_state.sql"
         self.db_path = str(db_path)
-        self.conn = sqlite3.connect(self.db_path)
+        self.conn = sqlite3.connect(self.db_path, timeout=busy_timeout)
+        self._shared = False
+        self._configure_connection()
         self._create_schema()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _configure_connection(self):
+        # WAL lets readers carry on while a switch is being written, and in WAL mode
+        # synchronous=NORMAL only gives up durability of the last commit on power loss.
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
     def _create_schema(self):
+        if self.get_schema_version() >= SCHEMA_VERSION:
+            return
         cur = self.conn.cursor()
         cur.execute('''
             CREATE TABLE IF NOT EXISTS switch_state_change (
@@ -52,18 +301,46 @@ class SwitchStateDB:
                 group_name TEXT NOT NULL DEFAULT '*'
             )
         ''')
-        cur.execute("PRAGMA table_info(jinja_templates)")
-        cols = [row[1] for row in cur.fetchall()]
-        if 'group_name' not in cols:
-            cur.execute('ALTER TABLE jinja_templates ADD COLUMN group_name TEXT NOT NULL DEFAULT "*"')
         self.conn.commit()
+        self.migrate()
+
+    def get_schema_version(self) -> int:
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self) -> None:
+        """
+        Apply any pending schema migrations in a single transaction.
+        The schema version is tracked in PRAGMA user_version.
+        """
+        cur = self.conn.cursor()
+        # IMMEDIATE so that concurrent processes opening an old database migrate it only once.
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.get_schema_version()
+            for migration in MIGRATIONS[version:]:
+                migration(cur)
+            if version < SCHEMA_VERSION:
+                cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            raise e
 
     def close(self):
+        # Shared connections stay open for the life of the thread, see get_shared_db().
+        if self._shared:
+            return
         self.conn.close()
 
     # Transaction methods
-    def begin(self):
-        self.conn.execute('BEGIN')
+    def begin(self, immediate: bool = False):
+        """
+        Begin a transaction.
+        Args:
+            immediate (bool): Take the write lock up front.  Use this for write transactions so
+                they wait out other writers (busy timeout) instead of failing when upgrading.
+        """
+        self.conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
 
     def commit(self):
         self.conn.commit()
@@ -73,22 +350,15 @@ class SwitchStateDB:
 
     # CRUD methods
     def create_switch_state_change(self, change: 'SwitchStateChange') -> None:
-        cur = self.conn.cursor()
+        """Insert a change.  It is given the next sequence number, making it the latest change."""
         try:
-            cur.execute('''
-                INSERT INTO switch_state_change (id, c_time, mode, group_name, locale)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                str(change.id),
-                change.c_time.isoformat(),
-                change.mode,
-                change.group,
-                change.locale
-            ))
-        except sqlite3.IntegrityError as e:
-            raise ValueError(f"SwitchStateChange with id {change.id} already exists.") from e
+            self.create_switch_state_changes([change])
+        except ValueError as e:
+            raise ValueError(f"SwitchStateChange with id {change.id} already exists.") from e.__cause__
 
     def get_switch_state_change(self, id: str) -> 'SwitchStateChange':
+        from fie_lonet_switch.models import SwitchStateChange
+
         cur = self.conn.cursor()
         cur.execute('SELECT id, c_time, mode, group_name, locale FROM switch_state_change WHERE id = ?', (id,))
         row = cur.fetchone()
@@ -103,27 +373,214 @@ class SwitchStateDB:
         raise LookupError(f"SwitchStateChange with id {id} not found.")
 
     def get_all_switch_state_changes(self) -> List['SwitchStateChange']:
-        cur = self.conn.cursor()
-        cur.execute('SELECT id, c_time, mode, group_name, locale FROM switch_state_change')
-        rows = cur.fetchall()
+        from fie_lonet_switch.models import SwitchStateChange
+
         return [
             SwitchStateChange(
-                id=row[0],
-                c_time=row[1],
-                mode=row[2],
-                group=row[3],
-                locale=row[4]
-            ) for row in rows
+                id=row.id,
+                c_time=row.c_time,
+                mode=row.mode,
+                group=row.group,
+                locale=row.locale
+            ) for row in self.get_all_switch_state_change_rows()
         ]
 
+    # The *_rows methods and the bulk methods below skip the pydantic models: rows are plain
+    # named tuples holding the stored strings, and bulk writes go through executemany.  Use
+    # them where many rows are handled at once; values are not validated.
+    def get_all_switch_state_change_rows(self) -> List[SwitchStateChangeRow]:
+        cur = self.conn.cursor()
+        cur.execute('SELECT id, c_time, mode, group_name, locale, seq, c_epoch_us FROM switch_state_change')
+        return [SwitchStateChangeRow(*row) for row in cur.fetchall()]
+
+    def create_switch_state_changes(self, changes: Iterable[Union[SwitchStateChangeRow, 'SwitchStateChange']]) -> None:
+        """
+        Insert many switch state changes with a single executemany.  Does not touch current_state.
+        Changes without a sequence number are numbered in the given order, after all others.
+        Args:
+            changes (Iterable[Union[SwitchStateChangeRow, SwitchStateChange]]): Rows or models.
+        """
+        params = [_switch_state_change_params(change) for change in changes]
+        missing = [change for change in params if change[5] is None]
+        given = max((change[5] for change in params if change[5] is not None), default=0)
+        first = self.reserve_switch_seqs(len(missing), at_least=given)
+        for offset, change in enumerate(missing):
+            change[5] = first + offset
+        cur = self.conn.cursor()
+        try:
+            cur.executemany('''
+                INSERT INTO switch_state_change (id, c_time, mode, group_name, locale, seq, c_epoch_us)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', params)
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"A SwitchStateChange already exists: {e}") from e
+        self._add_history_count(len(params))
+
+    def delete_switch_state_changes(self, ids: Iterable[str]) -> int:
+        """
+        Delete many switch state changes by id with a single executemany.  Unknown ids are ignored.
+        Returns:
+            int: The number of deleted changes.
+        """
+        cur = self.conn.cursor()
+        cur.executemany('DELETE FROM switch_state_change WHERE id = ?', ((str(id),) for id in ids))
+        self._add_history_count(-cur.rowcount)
+        return cur.rowcount
+
+    def reserve_switch_seqs(self, count: int, at_least: int = 0) -> int:
+        """
+        Take the next count sequence numbers from the counter in settings.  The counter outlives
+        the rows, e.g. when a "*" switch clears the history, so numbers are never reused.
+        Args:
+            count (int): How many numbers to take.
+            at_least (int): Take numbers after this one, for rows that already have a number.
+        Returns:
+            int: The first of the numbers.
+        """
+        last = int(self.get_setting('switch.last_seq', '0'))
+        start = max(last, at_least)
+        if start + count != last:
+            self.set_setting('switch.last_seq', str(start + count))
+        return start + 1
+
+    def _add_history_count(self, delta: int) -> None:
+        """
+        Keep the history.count setting, the number of switch_state_change rows, up to date.
+        Every method that adds or deletes history calls this.  Only retention relies on the
+        count, and it recounts the rows whenever it runs.
+        """
+        if delta:
+            self.conn.execute('''
+                INSERT INTO settings (key, value) VALUES ('history.count', ?)
+                ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value
+            ''', (delta,))
+
+    def recount_switch_state_changes(self) -> int:
+        """
+        Count the history rows and store the count in the history.count setting, e.g. after
+        writing switch_state_change with SQL of your own.
+        Returns:
+            int: The number of changes.
+        """
+        count = self.count_switch_state_changes()
+        self.set_setting('history.count', str(count))
+        return count
+
+    def clear_switch_state_changes_before_all(self) -> int:
+        """
+        Delete the changes, and the current states, made before the latest "*" change, as a "*"
+        switch does.  Use it after adding changes other than by switching, e.g. an import.
+        Returns:
+            int: The number of deleted changes.
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT seq FROM current_state WHERE group_name = '*'")
+        row = cur.fetchone()
+        if row is None or row[0] is None:
+            return 0
+        cur.execute('DELETE FROM switch_state_change WHERE seq < ?', (row[0],))
+        deleted = cur.rowcount
+        self._add_history_count(-deleted)
+        cur.execute('DELETE FROM current_state WHERE seq < ?', (row[0],))
+        return deleted
+
+    def resequence_switch_state_changes(self, by_time: bool = False) -> None:
+        """
+        Renumber all changes after the counter and copy their new numbers to current_state,
+        e.g. after importing changes numbered on another machine.  Current states whose change
+        is not in the history are numbered along with the changes.
+        Args:
+            by_time (bool): Number the changes in c_time order instead of their current order.
+                Sequence numbers from different databases cannot be compared, times can.
+        """
+        cur = self.conn.cursor()
+        order = 'c_epoch_us, seq, id' if by_time else 'seq, c_epoch_us, id'
+        cur.execute(f'''
+            SELECT id, seq, c_epoch_us, 'switch_state_change' AS row_table FROM switch_state_change
+            UNION ALL
+            SELECT id, seq, c_epoch_us, 'current_state' FROM current_state
+            WHERE id NOT IN (SELECT id FROM switch_state_change)
+            ORDER BY {order}
+        ''')
+        rows = [(row[0], row[3]) for row in cur.fetchall()]
+        first = self.reserve_switch_seqs(len(rows))
+        for table in ('switch_state_change', 'current_state'):
+            cur.executemany(
+                f'UPDATE {table} SET seq = ? WHERE id = ?',
+                ((first + offset, id) for offset, (id, row_table) in enumerate(rows) if row_table == table),
+            )
+        cur.execute('''
+            UPDATE current_state SET seq = (SELECT seq FROM switch_state_change AS h WHERE h.id = current_state.id)
+            WHERE id IN (SELECT id FROM switch_state_change)
+        ''')
+
+    def iter_switch_state_changes(
+        self,
+        group: Optional[str] = None,
+        mode: Optional[str] = None,
+        locale: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        newest_first: bool = False,
+        page_size: int = 500,
+    ) -> Iterator[SwitchStateChangeRow]:
+        """
+        Iterate over the switch history in (c_time, id) order, optionally filtered.  Rows are
+        fetched a page at a time, each page starting after the last row of the previous one
+        (keyset pagination), so memory use does not grow with the size of the history and
+        every page is an index range scan.
+        Args:
+            group (Optional[str]): Only changes of this group.
+            mode (Optional[str]): Only changes to this mode ('lo' or 'net').
+            locale (Optional[str]): Only changes to this locale.
+            since (Optional[datetime]): Only changes made at or after this time.
+            until (Optional[datetime]): Only changes made before this time.
+            newest_first (bool): Iterate from the newest change to the oldest.
+            page_size (int): Rows fetched per query.
+        Returns:
+            Iterator[SwitchStateChangeRow]: The matching changes.
+        """
+        filters = []
+        params: List[Any] = []
+        for column, value in (('group_name', group), ('mode', mode), ('locale', locale)):
+            if value is not None:
+                filters.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            filters.append('c_time >= ?')
+            params.append(since.isoformat())
+        if until is not None:
+            filters.append('c_time < ?')
+            params.append(until.isoformat())
+        after = '<' if newest_first else '>'
+        order = 'DESC' if newest_first else 'ASC'
+        first_where = ' AND '.join(filters) or '1'
+        next_where = ' AND '.join(filters + [f'(c_time, id) {after} (?, ?)'])
+        last = None
+        while True:
+            cur = self.conn.cursor()
+            cur.execute(f'''
+                SELECT id, c_time, mode, group_name, locale, seq, c_epoch_us FROM switch_state_change
+                WHERE {first_where if last is None else next_where}
+                ORDER BY c_time {order}, id {order}
+                LIMIT ?
+            ''', params + ([] if last is None else [last.c_time, last.id]) + [page_size])
+            rows = cur.fetchall()
+            for row in rows:
+                yield SwitchStateChangeRow(*row)
+            if len(rows) < page_size:
+                return
+            last = SwitchStateChangeRow(*rows[-1])
+
     def update_switch_state_change(self, change: 'SwitchStateChange') -> None:
         cur = self.conn.cursor()
         cur.execute('''
             UPDATE switch_state_change
-            SET c_time = ?, mode = ?, group_name = ?, locale = ?
+            SET c_time = ?, c_epoch_us = ?, mode = ?, group_name = ?, locale = ?
             WHERE id = ?
         ''', (
             change.c_time.isoformat(),
+            _epoch_us(change.c_time),
             change.mode,
             change.group,
             change.locale,
@@ -137,6 +594,7 @@ class SwitchStateDB:
         cur.execute('DELETE FROM switch_state_change WHERE id = ?', (id,))
         if cur.rowcount == 0:
             raise LookupError(f"SwitchStateChange with id {id} not found for deletion.")
+        self._add_history_count(-1)
         
     def delete_switch_state_changes_for_group(self, group: str) -> None:
         """
@@ -147,16 +605,71 @@ class SwitchStateDB:
         cur = self.conn.cursor()
         cur.execute('DELETE FROM switch_state_change WHERE group_name = ?', (group,))
         # No error if nothing deleted; silent if group not found
+        self._add_history_count(-cur.rowcount)
 
     def get_latest_switch_state_change_for_group(self, group: str) -> 'SwitchStateChange':
+        from fie_lonet_switch.models import SwitchStateChange
+
+        row = self.get_latest_switch_state_change_row_for_group(group)
+        return SwitchStateChange(
+            id=row.id,
+            c_time=row.c_time,
+            mode=row.mode,
+            group=row.group,
+            locale=row.locale
+        )
+
+    def get_latest_switch_state_change_row_for_group(self, group: str) -> SwitchStateChangeRow:
         cur = self.conn.cursor()
         cur.execute('''
-            SELECT id, c_time, mode, group_name, locale FROM switch_state_change
+            SELECT id, c_time, mode, group_name, locale, seq, c_epoch_us FROM switch_state_change
             WHERE group_name = ?
-            ORDER BY c_time DESC
+            ORDER BY seq DESC
             LIMIT 1
         ''', (group,))
         row = cur.fetchone()
+        if row:
+            return SwitchStateChangeRow(*row)
+        raise LookupError(f"No switch state change found for group '{group}'.")
+
+    def get_all_groups(self) -> List[str]:
+        cur = self.conn.cursor()
+        cur.execute('SELECT group_name FROM current_state')
+        rows = cur.fetchall()
+        return [row[0] for row in rows]
+
+    def get_all_resolved_states(self) -> List[ResolvedState]:
+        """
+        Resolve the current state of every group against the "*" override in a single query.
+        Uses the same precedence as get_switch_state_transaction: a group's own latest change
+        wins only if it was made after the latest "*" change.  A missing sequence number counts
+        as 0.
+        Returns:
+            List[ResolvedState]: One resolved state per group, ordered by group name.
+        """
+        cur = self.conn.cursor()
+        cur.execute('''
+            SELECT c.group_name,
+                   CASE WHEN s.group_name IS NULL OR COALESCE(c.seq, 0) > COALESCE(s.seq, 0) THEN c.mode ELSE s.mode END,
+                   CASE WHEN s.group_name IS NULL OR COALESCE(c.seq, 0) > COALESCE(s.seq, 0) THEN c.locale ELSE s.locale END,
+                   CASE WHEN s.group_name IS NULL OR COALESCE(c.seq, 0) > COALESCE(s.seq, 0) THEN c.c_time ELSE s.c_time END
+            FROM current_state AS c
+            LEFT JOIN current_state AS s ON s.group_name = '*'
+            ORDER BY c.group_name
+        ''')
+        return [ResolvedState(*row) for row in cur.fetchall()]
+
+    # current_state holds the latest change of every group.  It is kept up to date by the
+    # transaction functions below; the switch_state_change CRUD methods do not touch it.
+    def get_current_state_for_group(self, group: str) -> 'SwitchStateChange':
+        from fie_lonet_switch.models import SwitchStateChange
+
+        cur = self.conn.cursor()
+        cur.execute('''
+            SELECT id, c_time, mode, group_name, locale FROM current_state
+            WHERE group_name = ?
+        ''', (group,))
+        row = cur.fetchone()
         if row:
             return SwitchStateChange(
                 id=row[0],
@@ -165,34 +678,137 @@ class SwitchStateDB:
                 group=row[3],
                 locale=row[4]
             )
-        raise LookupError(f"No switch state change found for group '{group}'.")
+        raise LookupError(f"No current state found for group '{group}'.")
 
-    def get_all_groups(self) -> List[str]:
+    def get_current_state_row_for_group(self, group: str) -> CurrentState:
+        """Like get_current_state_for_group, but returns a plain row instead of a model."""
         cur = self.conn.cursor()
-        cur.execute('SELECT DISTINCT group_name FROM switch_state_change')
-        rows = cur.fetchall()
-        return [row[0] for row in rows]
+        cur.execute('''
+            SELECT group_name, mode, locale, c_time, seq FROM current_state
+            WHERE group_name = ?
+        ''', (group,))
+        row = cur.fetchone()
+        if row:
+            return CurrentState(*row)
+        raise LookupError(f"No current state found for group '{group}'.")
+
+    def get_all_current_state_rows(self) -> Dict[str, Tuple[str, CurrentState]]:
+        """
+        Get every group's own latest change.
+        Returns:
+            Dict[str, Tuple[str, CurrentState]]: The id of the change and its row, by group.
+        """
+        cur = self.conn.cursor()
+        cur.execute('SELECT id, group_name, mode, locale, c_time, seq FROM current_state')
+        return {row[1]: (row[0], CurrentState(*row[1:])) for row in cur.fetchall()}
+
+    def set_current_state(self, change: 'SwitchStateChange') -> None:
+        self.set_current_states([change])
+
+    def set_current_states(self, changes: Iterable[Union[SwitchStateChangeRow, 'SwitchStateChange']]) -> None:
+        """
+        Make each change the current state of its group, with a single executemany.  Changes
+        without a sequence number keep the one they have in the history, or get the next one.
+        """
+        params = [_switch_state_change_params(change) for change in changes]
+        cur = self.conn.cursor()
+        for change in params:
+            if change[5] is None:
+                cur.execute('SELECT seq FROM switch_state_change WHERE id = ?', (change[0],))
+                row = cur.fetchone()
+                change[5] = row[0] if row and row[0] is not None else self.reserve_switch_seqs(1)
+        cur.executemany('''
+            INSERT OR REPLACE INTO current_state (id, c_time, mode, group_name, locale, seq, c_epoch_us)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', params)
+
+    def delete_current_state_for_group(self, group: str) -> None:
+        cur = self.conn.cursor()
+        cur.execute('DELETE FROM current_state WHERE group_name = ?', (group,))
+
+    def clear_current_state(self) -> None:
+        cur = self.conn.cursor()
+        cur.execute('DELETE FROM current_state')
+
+    def rebuild_current_state(self) -> None:
+        """Recompute current_state from the switch_state_change history."""
+        cur = self.conn.cursor()
+        cur.execute('DELETE FROM current_state')
+        cur.execute(_INSERT_CURRENT_STATE_FROM_HISTORY)
+
+    def count_switch_state_changes(self) -> int:
+        cur = self.conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM switch_state_change')
+        return cur.fetchone()[0]
+
+    def compact_switch_state_changes(self) -> int:
+        """
+        Delete all history except the current state of every group.
+        Returns:
+            int: The number of deleted changes.
+        """
+        cur = self.conn.cursor()
+        cur.execute('DELETE FROM switch_state_change WHERE id NOT IN (SELECT id FROM current_state)')
+        self._add_history_count(-cur.rowcount)
+        return cur.rowcount
+
+    def apply_retention_policy(self, policy: RetentionPolicy) -> int:
+        """
+        Delete history that falls outside the retention policy.  The current state of every
+        group is always kept.
+        Args:
+            policy (RetentionPolicy): The retention policy to apply.
+        Returns:
+            int: The number of deleted changes.
+        """
+        cur = self.conn.cursor()
+        deleted = 0
+        if policy.keep_last > 0:
+            cur.execute('''
+                DELETE FROM switch_state_change WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY group_name ORDER BY seq DESC) AS rn
+                        FROM switch_state_change
+                    )
+                    WHERE rn > ?
+                )
+                AND id NOT IN (SELECT id FROM current_state)
+            ''', (policy.keep_last,))
+            deleted += cur.rowcount
+        if policy.max_age_days > 0:
+            cutoff = datetime.now() - timedelta(days=policy.max_age_days)
+            cur.execute('''
+                DELETE FROM switch_state_change
+                WHERE c_epoch_us < ? AND id NOT IN (SELECT id FROM current_state)
+            ''', (_epoch_us(cutoff),))
+            deleted += cur.rowcount
+        self._add_history_count(-deleted)
+        return deleted
 
     def clear_switch_state_changes(self) -> None:
         cur = self.conn.cursor()
         cur.execute('DELETE FROM switch_state_change')
+        self.set_setting('history.count', '0')
 
     # Jinja template CRUD methods
     def create_jinja_template(self, template: 'JinjaTemplate') -> None:
         cur = self.conn.cursor()
         try:
             cur.execute('''
-                INSERT INTO jinja_templates (id, path, group_name)
-                VALUES (?, ?, ?)
+                INSERT INTO jinja_templates (id, path, group_name, group_key)
+                VALUES (?, ?, ?, ?)
             ''', (
                 str(template.id),
                 template.path,
-                template.group
+                template.group,
+                _group_key(template.group)
             ))
         except sqlite3.IntegrityError as e:
             raise ValueError(f"JinjaTemplate with id {template.id} or path {template.path} already exists.") from e
 
     def get_jinja_template(self, id: str) -> 'JinjaTemplate':
+        from fie_lonet_switch.models import JinjaTemplate
+
         cur = self.conn.cursor()
         cur.execute('SELECT id, path, group_name FROM jinja_templates WHERE id = ?', (id,))
         row = cur.fetchone()
@@ -201,10 +817,78 @@ class SwitchStateDB:
         raise LookupError(f"JinjaTemplate with id {id} not found.")
 
     def get_all_jinja_templates(self) -> List['JinjaTemplate']:
+        from fie_lonet_switch.models import JinjaTemplate
+
+        return [JinjaTemplate(id=row.id, path=row.path, group=row.group) for row in self.get_all_jinja_template_rows()]
+
+    def get_all_jinja_template_rows(self) -> List[JinjaTemplateRow]:
+        """All templates as rows, in registration order."""
         cur = self.conn.cursor()
-        cur.execute('SELECT id, path, group_name FROM jinja_templates')
-        rows = cur.fetchall()
-        return [JinjaTemplate(id=row[0], path=row[1], group=row[2]) for row in rows]
+        cur.execute('SELECT id, path, group_name FROM jinja_templates ORDER BY rowid')
+        return [JinjaTemplateRow(*row) for row in cur.fetchall()]
+
+    def create_jinja_templates(self, templates: Iterable[Union[JinjaTemplateRow, 'JinjaTemplate']]) -> None:
+        """Register many templates with a single executemany. Paths are not checked for a .jinja suffix."""
+        cur = self.conn.cursor()
+        try:
+            cur.executemany('''
+                INSERT INTO jinja_templates (id, path, group_name, group_key)
+                VALUES (?, ?, ?, ?)
+            ''', (
+                (str(template.id), template.path, template.group, _group_key(template.group))
+                for template in templates
+            ))
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"A JinjaTemplate already exists: {e}") from e
+
+    def delete_jinja_templates_by_path(self, paths: Iterable[str]) -> int:
+        """
+        Delete many templates by path with a single executemany.  Unknown paths are ignored.
+        Returns:
+            int: The number of deleted templates.
+        """
+        cur = self.conn.cursor()
+        cur.executemany('DELETE FROM jinja_templates WHERE path = ?', ((path,) for path in paths))
+        return cur.rowcount
+
+    def get_jinja_templates_for_group(self, group: str) -> List['JinjaTemplate']:
+        """
+        Get the templates rendered when a group is switched, in registration order.
+        Switching "*" renders every template.  Switching any other group renders only the
+        templates registered for that group; "*" templates are not rendered.
+        Group names are compared case-insensitively.
+        Args:
+            group (str): The switched group.
+        Returns:
+            List[JinjaTemplate]: The templates of the group.
+        """
+        if group == "*":
+            return self.get_all_jinja_templates()
+        return self.get_jinja_templates_for_groups([group])
+
+    def get_jinja_templates_for_groups(self, groups: List[str]) -> List['JinjaTemplate']:
+        """
+        Get the templates registered for any of several groups, in registration order.  Unlike
+        get_jinja_templates_for_group, "*" is matched like any other group name.
+        """
+        from fie_lonet_switch.models import JinjaTemplate
+
+        return [
+            JinjaTemplate(id=row.id, path=row.path, group=row.group)
+            for row in self.get_jinja_template_rows_for_groups(groups)
+        ]
+
+    def get_jinja_template_rows_for_groups(self, groups: List[str]) -> List[JinjaTemplateRow]:
+        """Like get_jinja_templates_for_groups, but returns rows."""
+        if not groups:
+            return []
+        cur = self.conn.cursor()
+        cur.execute(f'''
+            SELECT id, path, group_name FROM jinja_templates
+            WHERE group_key IN ({', '.join('?' for _ in groups)})
+            ORDER BY rowid
+        ''', [_group_key(group) for group in groups])
+        return [JinjaTemplateRow(*row) for row in cur.fetchall()]
 
     def update_jinja_template(self, template: 'JinjaTemplate') -> None:
         cur = self.conn.cursor()
@@ -212,11 +896,13 @@ class SwitchStateDB:
             cur.execute('''
                 UPDATE jinja_templates
                 SET path = ?,
-                    group_name = ?
+                    group_name = ?,
+                    group_key = ?
                 WHERE id = ?
             ''', (
                 template.path,
                 template.group,
+                _group_key(template.group),
                 str(template.id)
             ))
         except sqlite3.IntegrityError as e:
@@ -234,7 +920,120 @@ class SwitchStateDB:
         if cur.rowcount == 0:
             raise LookupError(f"JinjaTemplate with id {id} not found for deletion.")
 
+    # Settings methods
+    def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        cur = self.conn.cursor()
+        cur.execute('SELECT value FROM settings WHERE key = ?', (key,))
+        row = cur.fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key: str, value: str) -> None:
+        cur = self.conn.cursor()
+        cur.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def get_retention_policy(self) -> RetentionPolicy:
+        defaults = RetentionPolicy()
+        return RetentionPolicy(
+            keep_last=int(self.get_setting('retention.keep_last', str(defaults.keep_last))),
+            max_age_days=float(self.get_setting('retention.max_age_days', str(defaults.max_age_days))),
+            threshold=int(self.get_setting('retention.threshold', str(defaults.threshold))),
+        )
+
+    def set_retention_policy(self, policy: RetentionPolicy) -> None:
+        if policy.keep_last < 0 or policy.max_age_days < 0 or policy.threshold < 0:
+            raise ValueError("Retention policy values must not be negative.")
+        self.set_setting('retention.keep_last', str(policy.keep_last))
+        self.set_setting('retention.max_age_days', str(policy.max_age_days))
+        self.set_setting('retention.threshold', str(policy.threshold))
+        # Re-evaluate the new policy on the next switch.
+        self.set_setting('retention.next_run', str(policy.threshold))
+
+    # Side effect job methods
+    def create_side_effect_job(self, specs: List[SwitchSpec]) -> str:
+        """
+        Record a pending side effect run for a batch of switches.
+        Returns:
+            str: The id of the new job.
+        """
+        job_id = str(uuid.uuid4())
+        cur = self.conn.cursor()
+        cur.execute('''
+            INSERT INTO side_effect_jobs (id, c_time, status, specs)
+            VALUES (?, ?, 'pending', ?)
+        ''', (job_id, datetime.now().isoformat(), json.dumps([list(spec) for spec in specs])))
+        return job_id
+
+    def get_side_effect_job(self, id: str) -> SideEffectJob:
+        cur = self.conn.cursor()
+        cur.execute('''
+            SELECT id, c_time, status, specs, started, finished, detail
+            FROM side_effect_jobs WHERE id = ?
+        ''', (id,))
+        row = cur.fetchone()
+        if row:
+            return _side_effect_job_from_row(row)
+        raise LookupError(f"Side effect job with id {id} not found.")
+
+    def get_side_effect_jobs(self, status: Optional[str] = None, limit: int = 20) -> List[SideEffectJob]:
+        """
+        Get the most recent side effect jobs, newest first.
+        Args:
+            status (Optional[str]): Only return jobs with this status.
+            limit (int): Maximum number of jobs returned. A negative limit returns all of them.
+        """
+        cur = self.conn.cursor()
+        where = 'WHERE status = ?' if status else ''
+        params = (status, limit) if status else (limit,)
+        cur.execute(f'''
+            SELECT id, c_time, status, specs, started, finished, detail
+            FROM side_effect_jobs {where}
+            ORDER BY c_time DESC LIMIT ?
+        ''', params)
+        return [_side_effect_job_from_row(row) for row in cur.fetchall()]
+
+    def claim_side_effect_job(self, id: str) -> bool:
+        """
+        Mark a pending job as running.
+        Returns:
+            bool: False if the job is not pending, e.g. another worker already claimed it.
+        """
+        cur = self.conn.cursor()
+        cur.execute('''
+            UPDATE side_effect_jobs SET status = 'running', started = ?
+            WHERE id = ? AND status = 'pending'
+        ''', (datetime.now().isoformat(), id))
+        return cur.rowcount == 1
+
+    def finish_side_effect_job(self, id: str, status: Literal['done', 'failed'], detail: str = "") -> None:
+        cur = self.conn.cursor()
+        cur.execute('''
+            UPDATE side_effect_jobs SET status = ?, finished = ?, detail = ?
+            WHERE id = ?
+        ''', (status, datetime.now().isoformat(), detail, id))
+        if cur.rowcount == 0:
+            raise LookupError(f"Side effect job with id {id} not found for update.")
+
+    def prune_side_effect_jobs(self, keep: int = SIDE_EFFECT_JOBS_KEPT) -> int:
+        """Delete all but the newest keep finished jobs. Returns the number deleted."""
+        cur = self.conn.cursor()
+        cur.execute('''
+            DELETE FROM side_effect_jobs WHERE status IN ('done', 'failed') AND id NOT IN (
+                SELECT id FROM side_effect_jobs WHERE status IN ('done', 'failed')
+                ORDER BY c_time DESC LIMIT ?
+            )
+        ''', (keep,))
+        return cur.rowcount
+
+    def get_applied_side_effects(self) -> Dict[str, List[str]]:
+        """The [mode, locale] state that side effects were last applied for, by group."""
+        return json.loads(self.get_setting('side_effects.applied', '{}'))
+
+    def set_applied_side_effects(self, applied: Dict[str, List[str]]) -> None:
+        self.set_setting('side_effects.applied', json.dumps(applied, sort_keys=True))
+
     def get_jinja_template_by_path(self, path: str) -> 'JinjaTemplate':
+        from fie_lonet_switch.models import JinjaTemplate
+
         cur = self.conn.cursor()
         cur.execute('SELECT id, path, group_name FROM jinja_templates WHERE path = ?', (path,))
         row = cur.fetchone()
@@ -248,6 +1047,116 @@ class SwitchStateDB:
         if cur.rowcount == 0:
             raise LookupError(f"JinjaTemplate with path {path} not found for deletion.")
 
+def _switch_state_change_params(change: Union[SwitchStateChangeRow, 'SwitchStateChange']) -> List[Any]:
+    """The (id, c_time, mode, group, locale, seq, c_epoch_us) column values of a change. seq may be None."""
+    c_time = change.c_time
+    c_epoch_us = getattr(change, 'c_epoch_us', None)
+    return [
+        str(change.id),
+        c_time if isinstance(c_time, str) else c_time.isoformat(),
+        change.mode,
+        change.group,
+        change.locale,
+        getattr(change, 'seq', None),
+        _epoch_us(c_time) if c_epoch_us is None else c_epoch_us,
+    ]
+
+def _epoch_us(c_time: Union[str, datetime]) -> int:
+    """
+    Microseconds since the Unix epoch of a c_time.  Times without a timezone are taken as local
+    time, which is how the switch transactions write them.
+    """
+    if isinstance(c_time, str):
+        c_time = datetime.fromisoformat(c_time)
+    return int(c_time.replace(microsecond=0).timestamp()) * 1_000_000 + c_time.microsecond
+
+def _group_key(group: str) -> str:
+    """The jinja_templates.group_key of a group name: templates match groups ignoring case."""
+    return group.lower()
+
+def _side_effect_job_from_row(row: Tuple) -> SideEffectJob:
+    specs = [SwitchSpec(*spec) for spec in json.loads(row[3])]
+    return SideEffectJob(row[0], row[1], row[2], specs, row[4], row[5], row[6])
+
+_shared_dbs = threading.local()
+
+def get_shared_db(db_path: str = None) -> SwitchStateDB:
+    """
+    Get a cached database connection for the current thread, so one process does not keep
+    reopening the database.  close() is a no-op on shared connections; use close_shared_db().
+    Args:
+        db_path (str): The database path. Defaults to the user's database.
+    Returns:
+        SwitchStateDB: The shared database connection.
+    """
+    if db_path is None:
+        db_path = get_config_dir() / "switch_state.sql"
+    db_path = str(db_path)
+    dbs: Dict[str, SwitchStateDB] = getattr(_shared_dbs, "dbs", None)
+    if dbs is None:
+        dbs = _shared_dbs.dbs = {}
+    db = dbs.get(db_path)
+    if db is None:
+        db = SwitchStateDB(db_path)
+        db._shared = True
+        dbs[db_path] = db
+    return db
+
+def close_shared_db(db_path: str = None) -> None:
+    """Close the current thread's shared connection(s). Closes all of them if no path is given."""
+    dbs: Dict[str, SwitchStateDB] = getattr(_shared_dbs, "dbs", {})
+    paths = list(dbs) if db_path is None else [str(db_path)]
+    for path in paths:
+        db = dbs.pop(path, None)
+        if db is not None:
+            db.conn.close()
+
+def _notify_state_changed(db: SwitchStateDB) -> None:
+    """Refresh the state snapshot and let a running user daemon know that its cached switch state is stale."""
+    from fie_lonet_switch.metrics import span
+    from fie_lonet_switch.user_daemon import notify_user_daemon
+
+    with span("switch.snapshot"):
+        try:
+            write_state_snapshot_transaction(db)
+        except (OSError, sqlite3.Error):
+            # The switch is committed, so leave no stale snapshot behind rather than failing it,
+            # e.g. when the write lock could not be had within the busy timeout.
+            _remove_state_snapshot(db)
+    with span("switch.notify_daemon"):
+        notify_user_daemon(db.db_path)
+
+def write_state_snapshot_transaction(db: SwitchStateDB) -> None:
+    """
+    Write the snapshot file of resolved states next to the database (see snapshot.py).
+    The states are read under the write lock, so snapshots are written in commit order and a
+    slow writer never replaces a newer snapshot with an older one.
+    Args:
+        db (SwitchStateDB): The database connection.
+    """
+    from fie_lonet_switch.snapshot import snapshot_path_for_db, write_snapshot
+
+    path = snapshot_path_for_db(db.db_path)
+    if path is None:
+        return
+    db.begin(immediate=True)
+    try:
+        write_snapshot(path, db.get_all_resolved_states())
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+
+def _remove_state_snapshot(db: SwitchStateDB) -> None:
+    from fie_lonet_switch.snapshot import snapshot_path_for_db
+
+    path = snapshot_path_for_db(db.db_path)
+    try:
+        if path is not None:
+            path.unlink()
+    except OSError:
+        pass
+
 def switch_change_transaction(db: SwitchStateDB, switch_to:Literal['lo', 'net'], group:str = "*", locale:str = "") -> None:
     """
     Perform a switch change transaction.
@@ -258,26 +1167,67 @@ def switch_change_transaction(db: SwitchStateDB, switch_to:Literal['lo', 'net'],
         group (str): The group name for the switch event.
         locale (str): The locale for the switch event.
     """
-    change = SwitchStateChange(mode=switch_to, group=group, locale=locale)
-    db.begin()
-
-    if group == "*":
-        # a * change overrides all things.
-        db.clear_switch_state_changes()
-
-    change = SwitchStateChange(
-        id=uuid.uuid4(),
-        c_time=datetime.now(),
-        mode=switch_to,
-        group=group,
-        locale=locale
-    )
+    switch_changes_batch_transaction(db, [SwitchSpec(switch_to, group, locale)])
+
+def switch_changes_batch_transaction(
+    db: SwitchStateDB,
+    specs: List[SwitchSpec],
+    queue_side_effects: bool = False,
+) -> Optional[str]:
+    """
+    Apply several switch changes atomically, in order, in a single transaction.
+    As with single switches, a "*" change clears every change before it.
+
+    Args:
+        db (SwitchStateDB): The database connection.
+        specs (List[SwitchSpec]): The switches to apply.
+        queue_side_effects (bool): Also record a pending side effect job for the switches,
+            committed together with them.
+    Returns:
+        Optional[str]: The id of the side effect job, if one was queued.
+    """
+    from fie_lonet_switch.models import SwitchStateChange
+
+    # Validate everything before touching the database.
+    changes = [SwitchStateChange(mode=spec.mode, group=spec.group, locale=spec.locale) for spec in specs]
+    db.begin(immediate=True)
     try:
-        db.create_switch_state_change(change)
+        c_time = None
+        kept = []
+        for change in changes:
+            # The sequence numbers order the batch; distinct times keep the history listing in
+            # the same order.
+            now = datetime.now()
+            c_time = now if c_time is None or now > c_time else c_time + timedelta(microseconds=1)
+            change.c_time = c_time
+            if change.group == "*":
+                # a * change overrides all things, including earlier changes of this batch.
+                kept = []
+            kept.append(change)
+        if kept and kept[0].group == "*":
+            db.clear_switch_state_changes()
+            db.clear_current_state()
+        first_seq = db.reserve_switch_seqs(len(kept))
+        kept = [
+            SwitchStateChangeRow(
+                str(change.id), change.c_time.isoformat(), change.mode, change.group, change.locale,
+                first_seq + offset, _epoch_us(change.c_time),
+            )
+            for offset, change in enumerate(kept)
+        ]
+        db.create_switch_state_changes(kept)
+        db.set_current_states({change.group: change for change in kept}.values())
+        job_id = None
+        if queue_side_effects:
+            job_id = db.create_side_effect_job(specs)
+            db.prune_side_effect_jobs()
+        _apply_retention_if_due(db)
         db.commit()
     except Exception as e:
         db.rollback()
         raise e
+    _notify_state_changed(db)
+    return job_id
     
 def get_switch_state_transaction(db: SwitchStateDB, group:str="*") -> Tuple[str,str]:
     """
@@ -289,14 +1239,14 @@ def get_switch_state_transaction(db: SwitchStateDB, group:str="*") -> Tuple[str,
     Returns:
         Tuple[switch_state:str,locale:str]: The current switchstate is ('lo' or 'net') and the locale for a net switch.
     """
-    # Get the latest switch state change for the specified group or set None
+    # Get the current state for the specified group or set None
     try:
-        group_specific_change = db.get_latest_switch_state_change_for_group(group)
+        group_specific_change = db.get_current_state_row_for_group(group)
     except LookupError:
         group_specific_change = None
-    # Get the latest switch state change for all groups or set None
+    # Get the current state for all groups or set None
     try:
-        all_change = db.get_latest_switch_state_change_for_group("*")
+        all_change = db.get_current_state_row_for_group("*")
     except LookupError:
         all_change = None
 
@@ -313,27 +1263,114 @@ def get_switch_state_transaction(db: SwitchStateDB, group:str="*") -> Tuple[str,
             # If only the group-specific change is found, return that
             return group_specific_change.mode, group_specific_change.locale
         else:
-            # Compare the creation times and return the most recent one
-            if group_specific_change.c_time > all_change.c_time:
+            # Compare the sequence numbers and return the most recent one
+            if (group_specific_change.seq or 0) > (all_change.seq or 0):
                 return group_specific_change.mode, group_specific_change.locale
             else:
                 return all_change.mode, all_change.locale
 
 def compact_db_transaction(db: SwitchStateDB) -> None:
     """
-    Compact the database to save space.
+    Compact the database to save space.  Keeps only the current state of every group.
     
     Args:
         db (SwitchStateDB): The database connection.
     """
-    db.begin()
-    to_keep:List[SwitchStateChange] = []
+    db.begin(immediate=True)
     try:
-        for group in db.get_all_groups():
-            to_keep.append(db.get_latest_switch_state_change_for_group(group))
-        db.clear_switch_state_changes()
-        for change in to_keep:
-            db.create_switch_state_change(change)
+        db.compact_switch_state_changes()
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+
+def retention_transaction(db: SwitchStateDB, policy: Optional[RetentionPolicy] = None) -> int:
+    """
+    Apply a retention policy to the switch state history in a transaction.
+    Args:
+        db (SwitchStateDB): The database connection.
+        policy (Optional[RetentionPolicy]): The policy to apply. Defaults to the stored policy.
+    Returns:
+        int: The number of deleted changes.
+    """
+    db.begin(immediate=True)
+    try:
+        if policy is None:
+            policy = db.get_retention_policy()
+        deleted = db.apply_retention_policy(policy)
+        db.commit()
+        return deleted
+    except Exception as e:
+        db.rollback()
+        raise e
+
+def _apply_retention_if_due(db: SwitchStateDB) -> None:
+    """
+    Apply the stored retention policy once history has grown past its threshold.  Must be
+    called inside a write transaction.
+    """
+    next_run = int(db.get_setting('retention.next_run', str(RetentionPolicy().threshold)))
+    if next_run <= 0:
+        return
+    # The counter saves counting the history on every switch.
+    if int(db.get_setting('history.count', '0')) <= next_run:
+        return
+    policy = db.get_retention_policy()
+    if policy.threshold <= 0:
+        return
+    db.apply_retention_policy(policy)
+    # Recount, so that history written past the counter is caught up with here.
+    remaining = db.recount_switch_state_changes()
+    # If the policy keeps more than the threshold, wait for history to double before
+    # trying again rather than rescanning it on every switch.
+    db.set_setting('retention.next_run', str(max(policy.threshold, 2 * remaining)))
+
+def claim_side_effect_job_transaction(db: SwitchStateDB, job_id: str) -> bool:
+    """
+    Claim a pending side effect job so that only one worker runs it.
+    Args:
+        db (SwitchStateDB): The database connection.
+        job_id (str): The job to claim.
+    Returns:
+        bool: True if the job was pending and is now running.
+    """
+    db.begin(immediate=True)
+    try:
+        claimed = db.claim_side_effect_job(job_id)
+        db.commit()
+        return claimed
+    except Exception as e:
+        db.rollback()
+        raise e
+
+def finish_side_effect_job_transaction(db: SwitchStateDB, job_id: str, status: Literal['done', 'failed'], detail: str = "") -> None:
+    """
+    Record the outcome of a side effect job.
+    Args:
+        db (SwitchStateDB): The database connection.
+        job_id (str): The job that finished.
+        status (Literal['done', 'failed']): Its outcome.
+        detail (str): A summary or error message.
+    """
+    db.begin(immediate=True)
+    try:
+        db.finish_side_effect_job(job_id, status, detail)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+
+def mark_side_effects_applied_transaction(db: SwitchStateDB, applied: Dict[str, List[str]]) -> None:
+    """
+    Record the state whose side effects were last applied.  Only side effect runs write it,
+    and they hold the switch lock while doing so.
+    Args:
+        db (SwitchStateDB): The database connection.
+        applied (Dict[str, List[str]]): The applied [mode, locale] by group.
+    """
+    db.begin(immediate=True)
+    try:
+        db.set_applied_side_effects(applied)
         db.commit()
     except Exception as e:
         db.rollback()
@@ -346,10 +1383,12 @@ def clear_group_transaction(db: SwitchStateDB, group: str) -> None:
         db (SwitchStateDB): The database connection.
         group (str): The group name to clear.
     """
-    db.begin()
+    db.begin(immediate=True)
     try:
         db.delete_switch_state_changes_for_group(group)
+        db.delete_current_state_for_group(group)
         db.commit()
     except Exception as e:
         db.rollback()
-        raise e
\ No newline at end of file
+        raise e
+    _notify_state_changed(db)
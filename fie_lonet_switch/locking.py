@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """
+    An exclusive lock on a file, shared by all processes (and threads) that open the same path.
+    The lock is advisory: it only excludes other FileLock users.  It is released when the
+    holder closes it or exits, so a crashed process never leaves it stuck.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def acquire(self, timeout: Optional[float] = None, poll_interval: float = 0.05) -> bool:
+        """
+        Take the lock, waiting for the current holder to release it.
+        Args:
+            timeout (Optional[float]): Seconds to wait. None waits for as long as it takes.
+            poll_interval (float): Seconds between attempts while waiting with a timeout.
+        Returns:
+            bool: False if the timeout passed without getting the lock.
+        """
+        if self._fd is not None:
+            raise RuntimeError(f"{self.path} is already locked by this FileLock.")
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not self._try_lock(fd, blocking=deadline is None):
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    return False
+                time.sleep(poll_interval)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            if sys.platform == "win32":
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _try_lock(fd: int, blocking: bool) -> bool:
+        if sys.platform == "win32":
+            os.lseek(fd, 0, os.SEEK_SET)
+            while True:
+                try:
+                    # LK_LOCK gives up after about 10 seconds, so keep trying when blocking.
+                    msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    return True
+                except OSError:
+                    if not blocking:
+                        return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
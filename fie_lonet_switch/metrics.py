@@ -0,0 +1,105 @@
+"""
+Timing spans for the phases of a switch.
+
+Code wraps its phases in span() or reports finished work with record_span().  Spans go to
+the registered listeners, e.g. a SpanRecorder behind ``switch --profile``, or a bridge to
+a metrics or tracing system:
+
+    def to_statsd(name, start, duration, attributes):
+        statsd.timing(name, duration * 1000)
+
+    add_span_listener(to_statsd)
+
+Listeners may be called from worker threads.  Without listeners a span only costs two clock
+reads.
+"""
+import contextlib
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List
+
+# Called with the span's name, its start (time.perf_counter()), its duration in seconds and
+# its attributes.
+SpanListener = Callable[[str, float, float, Dict[str, Any]], None]
+
+_listeners: List[SpanListener] = []
+_listeners_lock = threading.Lock()
+
+
+def add_span_listener(listener: SpanListener) -> None:
+    """Send all spans to a listener from now on."""
+    global _listeners
+    with _listeners_lock:
+        # Copy on write, so spans are sent without taking the lock.
+        _listeners = _listeners + [listener]
+
+
+def remove_span_listener(listener: SpanListener) -> None:
+    global _listeners
+    with _listeners_lock:
+        _listeners = [other for other in _listeners if other is not listener]
+
+
+def record_span(name: str, start: float, duration: float, **attributes: Any) -> None:
+    """
+    Report a finished span.
+    Args:
+        name (str): What was timed, e.g. "switch.template".
+        start (float): When it started, as time.perf_counter().
+        duration (float): How long it took in seconds.
+        **attributes: Details such as the template path or the outcome.
+    """
+    for listener in _listeners:
+        listener(name, start, duration, attributes)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time the body of a with statement as a span.  The body may add attributes to the
+    yielded dict, e.g. a count only known at the end.
+    """
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        record_span(name, start, time.perf_counter() - start, **attributes)
+
+
+class SpanRecorder:
+    """
+    Collects spans while registered, e.g. for one switch.  Use it as a context manager:
+
+        with SpanRecorder() as recorder:
+            do_switch("lo")
+        print(recorder.to_dict())
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans: List[Dict[str, Any]] = []
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        add_span_listener(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        remove_span_listener(self)
+
+    def __call__(self, name: str, start: float, duration: float, attributes: Dict[str, Any]) -> None:
+        entry = {"name": name, "start": start - self.start, "duration": duration}
+        entry.update(attributes)
+        with self._lock:
+            self.spans.append(entry)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        The recorded spans in start order, with start offsets in seconds from when recording
+        began, and the total recorded time.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda entry: entry["start"])
+        total = max((entry["start"] + entry["duration"] for entry in spans), default=0.0)
+        return {"total": total, "spans": spans}
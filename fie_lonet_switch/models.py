@@ -0,0 +1,23 @@
+import uuid
+from datetime import datetime
+from typing import Literal
+
+from pydantic import BaseModel, Field, validator
+
+class SwitchStateChange(BaseModel):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, description="Unique identifier for the state change event.")
+    c_time: datetime = Field(default_factory=datetime.now, description="Creation time (local time) of the state change event.")
+    mode: Literal["lo", "net"] = Field(..., description="Switch mode: 'lo' for local, 'net' for network.")
+    group: str = Field(default="*", description="Group name for the switch event.")
+    locale: str = Field(default="", description="Locale for the switch event.")
+
+class JinjaTemplate(BaseModel):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, description="Unique identifier for the template.")
+    path: str = Field(..., description="Path to .jinja template file")
+    group: str = Field(default="*", description="Group associated with this template.")
+
+    @validator('path')
+    def _validate_path(cls, v: str) -> str:
+        if not v.endswith('.jinja'):
+            raise ValueError('path must end with .jinja')
+        return v
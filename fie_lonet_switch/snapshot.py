@@ -0,0 +1,103 @@
+"""
+A snapshot file of the resolved state of every group, for readers that cannot afford to open
+the database, such as shell prompts.
+
+The snapshot is rewritten after every committed switch or group clear.  A new version is
+written to a temporary file and renamed over the old one, so readers always see a complete
+snapshot and never wait for the writer.  This module only uses the standard library and does
+not import sqlite3 or pydantic, to keep it cheap for readers.
+
+The file is compact JSON: {"v": 1, "groups": {"<group>": ["<mode>", "<locale>"], ...}}.
+"""
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+from fie_lonet_switch.config import get_config_dir
+
+SNAPSHOT_FILE_NAME = "state_snapshot.json"
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Parsed snapshots by path, with the (mtime, size, inode) of the file they were read from.
+_snapshots: Dict[str, Tuple[Tuple[int, int, int], Dict[str, Tuple[str, str]]]] = {}
+
+
+def snapshot_path_for_db(db_path: Optional[str]) -> Optional[Path]:
+    """The snapshot lives next to the database it is taken from. None for in-memory databases."""
+    if db_path is None:
+        return get_config_dir(create=False) / SNAPSHOT_FILE_NAME
+    if db_path == ":memory:":
+        return None
+    return Path(db_path).parent / SNAPSHOT_FILE_NAME
+
+
+def write_snapshot(path: Path, states: Iterable[Tuple[str, str, str]]) -> None:
+    """
+    Atomically replace the snapshot file.
+    Args:
+        path (Path): The snapshot file.
+        states (Iterable[Tuple[str, str, str]]): The resolved (group, mode, locale) of every group,
+            e.g. ResolvedState rows.
+    """
+    data = {
+        "v": SNAPSHOT_FORMAT_VERSION,
+        "groups": {state[0]: [state[1], state[2]] for state in states},
+    }
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"), sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_snapshot(path: Optional[Path] = None) -> Dict[str, Tuple[str, str]]:
+    """
+    Read the resolved states from the snapshot file.  The parsed snapshot is cached until the
+    file is replaced, so repeated calls only cost a stat().
+    Args:
+        path (Optional[Path]): The snapshot file. Defaults to the one of the user's database.
+    Returns:
+        Dict[str, Tuple[str, str]]: The resolved (mode, locale) by group.  Raises OSError if
+            there is no snapshot yet and ValueError if it cannot be parsed.
+    """
+    # Plain string paths: building a Path costs more than the cached read itself.
+    key = os.path.join(os.path.expanduser("~"), ".fie_lonet_switch", SNAPSHOT_FILE_NAME) if path is None else str(path)
+    stat = os.stat(key)
+    cached = _snapshots.get(key)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size, stat.st_ino):
+        return cached[1]
+    with open(key, "rb") as f:
+        # The file may have been replaced since the stat(); cache what was actually read.
+        stat = os.fstat(f.fileno())
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stat.st_size == 0:
+            raise ValueError(f"Snapshot {key} is empty.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            snapshot = json.loads(data[:])
+    if snapshot.get("v") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Snapshot {key} has unknown format version {snapshot.get('v')!r}.")
+    states = {group: (state[0], state[1]) for group, state in snapshot["groups"].items()}
+    _snapshots[key] = (signature, states)
+    return states
+
+
+def get_snapshot_state(group: str = "*", path: Optional[Path] = None) -> Tuple[str, str]:
+    """
+    Get the resolved state of a group from the snapshot file.  Groups without a state of their
+    own resolve like in get_switch_state_transaction: to the "*" state, or to ("lo", "").
+    Args:
+        group (str): The group name. Defaults to "*".
+        path (Optional[Path]): The snapshot file. Defaults to the one of the user's database.
+    Returns:
+        Tuple[str, str]: The resolved mode ('lo' or 'net') and locale.
+    """
+    states = read_snapshot(path)
+    return states.get(group) or states.get("*") or ("lo", "")
@@ -0,0 +1,54 @@
+import importlib.util
+import re
+import sys
+import threading
+from pathlib import Path
+from types import ModuleType
+from typing import Dict, List, Tuple
+
+from fie_lonet_switch.config import get_config_dir
+
+# Loaded switch scripts by path, with the (mtime, size) of the file they were loaded from.
+_loaded_scripts: Dict[str, Tuple[Tuple[int, int], ModuleType]] = {}
+_loaded_scripts_lock = threading.Lock()
+
+
+def get_switch_script_paths() -> List[Path]:
+    """The homedir switch scripts (switch_*.py in the configuration directory), in name order."""
+    return sorted(get_config_dir().glob("switch_*.py"))
+
+
+def load_switch_script(path: Path) -> ModuleType:
+    """
+    Import a switch script.  The module is kept for the life of the process and only imported
+    again when the file's modification time or size changes, so long-lived hosts such as the
+    tray app and the user daemon pay a script's import cost once.  The source loader caches
+    the compiled script in __pycache__ next to it, which short-lived CLI runs benefit from.
+
+    Args:
+        path (Path): The script to load.
+    Returns:
+        ModuleType: The loaded module.  Raises ImportError if it cannot be loaded.
+    """
+    stat = path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size)
+    key = str(path)
+    with _loaded_scripts_lock:
+        loaded = _loaded_scripts.get(key)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+        # Every script gets its own module name, so scripts cannot clobber each other.
+        module_name = "fie_lonet_switch_script_" + re.sub(r"\W", "_", path.stem)
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        if spec is None or spec.loader is None:
+            raise ImportError(f"Could not load spec for {path}.")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            sys.modules.pop(module_name, None)
+            _loaded_scripts.pop(key, None)
+            raise
+        _loaded_scripts[key] = (signature, module)
+        return module
@@ -1,8 +1,50 @@
-from fie_lonet_switch.database import switch_change_transaction, SwitchStateDB
+import contextlib
+import queue
+import subprocess
+import sys
+import threading
+from fie_lonet_switch.config import DEFAULT_HOOK_WORKERS, DEFAULT_RENDER_WORKERS, get_config_dir
+from fie_lonet_switch.database import (
+    claim_side_effect_job_transaction,
+    finish_side_effect_job_transaction,
+    mark_side_effects_applied_transaction,
+    switch_changes_batch_transaction,
+    SwitchSpec,
+    SwitchStateDB,
+    get_shared_db,
+)
+from fie_lonet_switch.locking import FileLock
+from fie_lonet_switch.metrics import record_span, span
+from fie_lonet_switch.switch_scripts import get_switch_script_paths, load_switch_script
+from fie_lonet_switch.tasks import run_concurrently
 from pathlib import Path
-from typing import Literal
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
-def do_switch(switch_to:Literal["lo","net"], group:str = "*", locale:str = "") -> None:
+class TemplateRenderResult(BaseModel):
+    path: str = Field(..., description="Path to the .jinja template file.")
+    output_path: str = Field(default="", description="Path the template was rendered to.")
+    status: Literal["rendered", "unchanged", "missing", "failed", "timeout"] = Field(..., description="Outcome of rendering the template.")
+    error: str = Field(default="", description="Error message for a missing, failed or timed out template.")
+    duration: float = Field(default=0.0, description="Seconds spent rendering the template.")
+
+class HookResult(BaseModel):
+    script: str = Field(..., description="Path to the homedir switch script.")
+    status: Literal["ok", "failed", "timeout", "skipped"] = Field(..., description="Outcome of running the script's switch_change.")
+    error: str = Field(default="", description="Error message for a failed, timed out or skipped script.")
+    duration: float = Field(default=0.0, description="Seconds spent in the script's switch_change.")
+
+def do_switch(
+    switch_to: Literal["lo", "net"],
+    group: str = "*",
+    locale: str = "",
+    render_workers: int = DEFAULT_RENDER_WORKERS,
+    template_timeout: Optional[float] = None,
+    hook_workers: int = DEFAULT_HOOK_WORKERS,
+    hook_timeout: Optional[float] = None,
+    background: Optional[Literal["thread", "process"]] = None,
+    force: bool = False,
+) -> Optional[str]:
     """
     Switch the state of the switch to either 'lo' or 'net'.
     
@@ -10,76 +52,596 @@ def do_switch(switch_to:Literal["lo","net"], group:str = "*", locale:str = "") -
         switch_to (str): The state to switch to ('lo' or 'net').
         group (str): The group name to filter by.
         locale (str): The locale to filter by.
+        render_workers (int): Number of templates rendered at once.
+        template_timeout (Optional[float]): Seconds each template may take to render. None means no timeout.
+        hook_workers (int): Number of homedir switch scripts run at once.
+        hook_timeout (Optional[float]): Seconds each homedir switch script may run. None means no timeout.
+        background (Optional[str]): Return once the switch is committed and leave the side effects
+            to a background job, see do_switch_batch().
+        force (bool): Render templates and run scripts even if the group's state did not change.
+    Returns:
+        Optional[str]: The id of the side effect job when running in the background.
+    """
+    return do_switch_batch(
+        [SwitchSpec(switch_to, group, locale)],
+        render_workers,
+        template_timeout,
+        hook_workers,
+        hook_timeout,
+        background,
+        force,
+    )
+
+
+def do_switch_batch(
+    specs: List[SwitchSpec],
+    render_workers: int = DEFAULT_RENDER_WORKERS,
+    template_timeout: Optional[float] = None,
+    hook_workers: int = DEFAULT_HOOK_WORKERS,
+    hook_timeout: Optional[float] = None,
+    background: Optional[Literal["thread", "process"]] = None,
+    force: bool = False,
+) -> Optional[str]:
+    """
+    Switch several groups at once.  All changes are committed in one transaction, then every
+    affected template is rendered once and the homedir switch scripts are loaded once.
+    Side effects only run for groups whose resolved state actually changed, unless forced.
+
+    With background set, the side effects (templates and scripts) are recorded as a job in the
+    same transaction and this returns right after the commit.  "thread" runs the job on a worker
+    thread of this process, which suits long-lived hosts such as the tray app.  "process" runs it
+    in a detached ``fie_lonet_switch jobs run`` process, which outlives a short CLI invocation.
+
+    Args:
+        specs (List[SwitchSpec]): The switches to apply, in order.
+        render_workers (int): Number of templates rendered at once.
+        template_timeout (Optional[float]): Seconds each template may take to render. None means no timeout.
+        hook_workers (int): Number of homedir switch scripts run at once.
+        hook_timeout (Optional[float]): Seconds each homedir switch script may run. None means no timeout.
+        background (Optional[str]): None, "thread" or "process", see above.
+        force (bool): Render templates and run scripts even for groups whose state did not change.
+    Returns:
+        Optional[str]: The id of the side effect job when running in the background.
+    """
+    if background not in (None, "thread", "process"):
+        raise ValueError(f"Unknown background mode {background!r}.")
+    for spec in specs:
+        print(f"Switching to {spec.mode} for group {spec.group} with locale {spec.locale}.")
+    with span("switch", switches=len(specs), background=background or ""):
+        db = get_shared_db()
+        with span("switch.commit"):
+            job_id = switch_changes_batch_transaction(db, specs, queue_side_effects=background is not None)
+        print(f"database updated.")
+        options = (render_workers, template_timeout, hook_workers, hook_timeout, force)
+        if background is None:
+            run_side_effects(specs, db, *options)
+            return None
+        if background == "thread":
+            _queue_side_effect_job(job_id, options)
+        else:
+            _spawn_side_effect_job(job_id, options)
+    print(f"Side effects queued as job {job_id}.")
+    return job_id
+
+
+def run_side_effects(
+    specs: List[SwitchSpec],
+    db: Optional[SwitchStateDB] = None,
+    render_workers: int = DEFAULT_RENDER_WORKERS,
+    template_timeout: Optional[float] = None,
+    hook_workers: int = DEFAULT_HOOK_WORKERS,
+    hook_timeout: Optional[float] = None,
+    force: bool = False,
+) -> Optional[Tuple[List[TemplateRenderResult], List[HookResult]]]:
+    """
+    Render the templates and run the homedir switch scripts for a committed batch of switches.
+
+    Side effect runs hold a lock shared by all processes, so overlapping switches never
+    interleave their file writes.  Once a run holds the lock it renders the groups' current
+    state rather than the one it was started for, and it skips groups whose current state has
+    already been applied, by a newer run or because the switch did not change it.  A burst of
+    switches thus renders the latest state once and drops the runs for the states in between,
+    and a redundant switch costs a database read.  If a template or script fails or times out,
+    the state of the run's groups is no longer known to be applied, so switching again applies
+    it, whatever the state switched to.
+    Args:
+        force (bool): Apply the current state even where it was already applied.
+    Returns:
+        Optional[Tuple[List[TemplateRenderResult], List[HookResult]]]: The template and script
+            results, or None if everything had already been applied.
+    """
+    if db is None:
+        db = get_shared_db()
+    with span("switch.side_effects") as attributes, contextlib.ExitStack() as stack:
+        with span("switch.lock_wait"):
+            stack.enter_context(_switch_lock(db))
+        todo, applied = _coalesce_side_effects(db, effective_switch_specs(specs), force)
+        attributes["skipped"] = not todo
+        if not todo:
+            print("Side effects skipped: the state is already applied (use force to apply it again).")
+            return None
+        with span("switch.templates") as template_attributes:
+            results = render_templates_for_specs(todo, db, render_workers, template_timeout)
+            template_attributes["count"] = len(results)
+        print_template_render_results(results)
+        with span("switch.hooks") as hook_attributes:
+            hook_results = run_homedir_switch_scripts(todo, hook_workers, hook_timeout)
+            hook_attributes["count"] = len(hook_results)
+        print_hook_results(hook_results)
+        if _failed_side_effects(results, hook_results):
+            # Some side effects of the run may have been applied and others not.  Scripts are
+            # told about every group of the run, so forget what was applied for all of them (and
+            # for everything after a "*" run) so that the next switch applies them again.
+            attributes["failed"] = True
+            run_groups = {spec.group for spec in todo}
+            kept = {} if "*" in run_groups else {
+                group: state for group, state in db.get_applied_side_effects().items()
+                if group not in run_groups and group != "*"
+            }
+            mark_side_effects_applied_transaction(db, kept)
+        else:
+            mark_side_effects_applied_transaction(db, applied)
+    return results, hook_results
+
+
+def _failed_side_effects(results: List[TemplateRenderResult], hook_results: List[HookResult]) -> List[str]:
+    """The paths of the templates and scripts that failed or timed out."""
+    failed = [result.path for result in results if result.status in ("missing", "failed", "timeout")]
+    failed += [result.script for result in hook_results if result.status in ("failed", "timeout")]
+    return failed
+
+
+SWITCH_LOCK_FILE_NAME = "switch.lock"
+
+def _switch_lock(db: SwitchStateDB) -> Any:
+    """The lock serializing side effect runs, kept next to the database."""
+    if db.db_path == ":memory:":
+        return contextlib.nullcontext()
+    return FileLock(Path(db.db_path).parent / SWITCH_LOCK_FILE_NAME)
+
+
+def _coalesce_side_effects(
+    db: SwitchStateDB,
+    specs: List[SwitchSpec],
+    force: bool = False,
+) -> Tuple[List[SwitchSpec], Dict[str, List[str]]]:
+    """
+    Work out which side effects a run still has to apply.  The run applies the current state
+    of the groups it was started for, and only of those whose state differs from the one their
+    side effects last applied: groups a newer run already covered are left out, as are
+    switches that did not change anything (e.g. switching to the mode already in effect).
+    Args:
+        db (SwitchStateDB): The database connection.
+        specs (List[SwitchSpec]): The switches the run was started for (see effective_switch_specs).
+        force (bool): Apply the current state even where it was already applied.
+    Returns:
+        Tuple[List[SwitchSpec], Dict[str, List[str]]]: The switches to apply, and the applied
+            [mode, locale] by group to record once they ran.
+    """
+    current = db.get_all_current_state_rows()
+    applied = db.get_applied_side_effects()
+
+    def resolved(group: str) -> List[str]:
+        # Same precedence as get_switch_state_transaction: a group's own row wins if it was
+        # made after the "*" row.
+        own = current.get(group, (None, None))[1]
+        all_row = current.get("*", (None, None))[1]
+        if own is not None and (all_row is None or (own.seq or 0) > (all_row.seq or 0)):
+            row = own
+        else:
+            row = all_row
+        return ["lo", ""] if row is None else [row.mode, row.locale]
+
+    def applied_state(group: str) -> Optional[List[str]]:
+        # A group without an entry of its own had the state applied for "*", like resolved().
+        # None if nothing is known to be applied, e.g. before the first run or after a failed
+        # one: the group then counts as changed.
+        return applied.get(group) or applied.get("*")
+
+    groups = []
+    for spec in specs:
+        # A group without a row of its own while "*" has one was cleared by a later "*"
+        # switch; that switch's run covers it.
+        if spec.group == "*" or spec.group in current or "*" not in current:
+            groups.append(spec.group)
+    if "*" in groups:
+        # "*" affects every group, including ones whose override it cleared.
+        groups = ["*"] + sorted((set(current) | set(applied)) - {"*"})
+    changed = [group for group in groups if force or applied_state(group) != resolved(group)]
+    if "*" in changed:
+        # The "*" switch renders every template and tells scripts about all groups.  Groups
+        # switched after it keep their own, newer state, so apply them after it.
+        todo_groups = ["*"] + sorted(group for group in current if group != "*")
+        new_applied = {group: resolved(group) for group in groups}
+    else:
+        todo_groups = changed
+        new_applied = dict(applied, **{group: resolved(group) for group in changed})
+    todo = [SwitchSpec(resolved(group)[0], group, resolved(group)[1]) for group in todo_groups]
+    return todo, new_applied
+
+
+def run_side_effect_job(
+    job_id: str,
+    db: Optional[SwitchStateDB] = None,
+    render_workers: int = DEFAULT_RENDER_WORKERS,
+    template_timeout: Optional[float] = None,
+    hook_workers: int = DEFAULT_HOOK_WORKERS,
+    hook_timeout: Optional[float] = None,
+    force: bool = False,
+) -> bool:
+    """
+    Run a pending side effect job and record whether it is done or failed.  A job fails if
+    any template or script fails or times out.
+    Args:
+        job_id (str): The job to run.
+        db (Optional[SwitchStateDB]): The database connection. Defaults to the shared connection.
+    Returns:
+        bool: False if the job was not pending, e.g. it already ran.
+    """
+    if db is None:
+        db = get_shared_db()
+    job = db.get_side_effect_job(job_id)
+    if not claim_side_effect_job_transaction(db, job_id):
+        return False
+    try:
+        outcome = run_side_effects(job.specs, db, render_workers, template_timeout, hook_workers, hook_timeout, force)
+    except Exception as e:
+        finish_side_effect_job_transaction(db, job_id, "failed", f"Error: {e}")
+        return True
+    if outcome is None:
+        finish_side_effect_job_transaction(db, job_id, "done", "Skipped: state already applied.")
+        return True
+    results, hook_results = outcome
+    failed = _failed_side_effects(results, hook_results)
+    detail = f"{len(results)} template(s), {len(hook_results)} script(s)"
+    if failed:
+        detail += "; failed: " + ", ".join(failed)
+    finish_side_effect_job_transaction(db, job_id, "failed" if failed else "done", detail)
+    return True
+
+
+_side_effect_jobs: "queue.Queue[Tuple[str, Tuple]]" = queue.Queue()
+_side_effect_worker: Optional[threading.Thread] = None
+_side_effect_worker_lock = threading.Lock()
+
+def _queue_side_effect_job(job_id: str, options: Tuple) -> None:
+    """Hand a job to this process's side effect worker thread, starting it if needed."""
+    global _side_effect_worker
+    _side_effect_jobs.put((job_id, options))
+    with _side_effect_worker_lock:
+        if _side_effect_worker is None:
+            _side_effect_worker = threading.Thread(
+                target=_run_side_effect_worker, name="fie_lonet_switch-side-effects", daemon=True
+            )
+            _side_effect_worker.start()
+
+
+def _run_side_effect_worker() -> None:
+    # One worker, so jobs run in the order they were committed.
+    while True:
+        job_id, options = _side_effect_jobs.get()
+        try:
+            run_side_effect_job(job_id, None, *options)
+        except Exception as e:
+            print(f"Error running side effect job {job_id}: {e}")
+
+
+def _spawn_side_effect_job(job_id: str, options: Tuple) -> None:
+    """Run a job in a detached ``fie_lonet_switch jobs run`` process."""
+    render_workers, template_timeout, hook_workers, hook_timeout, force = options
+    args = [sys.executable, "-m", "fie_lonet_switch.cli", "jobs", "run", job_id,
+            "--render-workers", str(render_workers), "--hook-workers", str(hook_workers)]
+    if template_timeout is not None:
+        args += ["--template-timeout", str(template_timeout)]
+    if hook_timeout is not None:
+        args += ["--hook-timeout", str(hook_timeout)]
+    if force:
+        args.append("--force")
+    kwargs: Dict[str, Any] = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        **kwargs,
+    )
+
+
+def effective_switch_specs(specs: List[SwitchSpec]) -> List[SwitchSpec]:
     """
-    print(f"Switching to {switch_to} for group {group} with locale {locale}.")
-    db = SwitchStateDB()
-    switch_change_transaction(db, switch_to, group, locale)
-    db.close()
-    print(f"database updated.")
-    do_switch_jinjas_in_db(switch_to, group, locale)
-    do_homedir_switch_scripts(switch_to, group, locale)
+    Reduce a batch of switches to the ones still in effect after it is applied: a "*" switch
+    supersedes everything before it, and only the last switch of each group counts.
+    """
+    last_all = max((index for index, spec in enumerate(specs) if spec.group == "*"), default=0)
+    latest: Dict[str, SwitchSpec] = {}
+    for spec in specs[last_all:]:
+        latest.pop(spec.group, None)
+        latest[spec.group] = spec
+    return list(latest.values())
 
 
-def do_homedir_switch_scripts(switch_to: Literal["lo", "net"], group: str = "*", locale: str = "") -> None:
+def do_homedir_switch_scripts(
+    switch_to: Literal["lo", "net"],
+    group: str = "*",
+    locale: str = "",
+    workers: int = DEFAULT_HOOK_WORKERS,
+    timeout: Optional[float] = None,
+) -> List[HookResult]:
     """Run any homedir switch scripts that exist."""
-    for script in Path.home().glob(".fie_lonet_switch/switch_*.py"):
-        print(f"Importing script {script}")
-        import importlib.util
-        spec = importlib.util.spec_from_file_location("switch_script", script)
-        if spec and spec.loader:
-            module = importlib.util.module_from_spec(spec)
-            try:
-                spec.loader.exec_module(module)
-                if hasattr(module, "switch_change"):
-                    func = getattr(module, "switch_change")
-                    if callable(func):
-                        print(f"Calling switch_change in {script}")
-                        func(switch_to, group, locale)
-                    else:
-                        print(f"switch_change in {script} is not callable.")
-                else:
-                    print(f"No switch_change function in {script}.")
-            except Exception as e:
-                print(f"Error importing or running {script}: {e}")
+    return run_homedir_switch_scripts([SwitchSpec(switch_to, group, locale)], workers, timeout)
+
+
+def run_homedir_switch_scripts(
+    specs: List[SwitchSpec],
+    workers: int = DEFAULT_HOOK_WORKERS,
+    timeout: Optional[float] = None,
+) -> List[HookResult]:
+    """
+    Load each homedir switch script once and call its switch_change for every switch.
+    Scripts run on a pool of worker threads, so a slow script only holds up the scripts that
+    declared they run after it.  A script declares this with a module level list of script
+    names (file names without .py), e.g. switch_after = ["switch_10_vpn"].
+
+    A script that times out cannot be stopped: it keeps running on its thread after this
+    returns, and so after the caller released the switch lock.  Unlike templates, whose late
+    output is dropped, its effects may overlap with those of the next switch.
+
+    Args:
+        specs (List[SwitchSpec]): The switches in effect.
+        workers (int): Number of scripts run at once. 1 runs them one after another.
+        timeout (Optional[float]): Seconds each script may run. None means no timeout.
+    Returns:
+        List[HookResult]: One result per script, in name order.
+    """
+    results: List[Optional[HookResult]] = []
+    funcs: List[Tuple[Path, Any]] = []
+    names: Dict[str, int] = {}
+    for script in get_switch_script_paths():
+        # Imports are not thread safe against each other, so scripts are loaded up front.
+        try:
+            with span("switch.hook_load", script=str(script)):
+                module = load_switch_script(script)
+        except Exception as e:
+            results.append(HookResult(script=str(script), status="failed", error=f"Error importing: {e}"))
+            continue
+        func = getattr(module, "switch_change", None)
+        if func is None:
+            results.append(HookResult(script=str(script), status="skipped", error="No switch_change function."))
+        elif not callable(func):
+            results.append(HookResult(script=str(script), status="skipped", error="switch_change is not callable."))
         else:
-            print(f"Could not load spec for {script}.")
+            names[script.stem] = len(funcs)
+            # Filled in once run.
+            results.append(None)
+            funcs.append((script, module))
+
+    run_after = []
+    for script, module in funcs:
+        after = getattr(module, "switch_after", None) or []
+        run_after.append([names[name] for name in after if name in names and name != script.stem])
+
+    def call(func):
+        for switch in specs:
+            func(switch.mode, switch.group, switch.locale)
+
+    outcomes = iter(run_concurrently(
+        [lambda module=module: call(module.switch_change) for _, module in funcs],
+        workers,
+        timeout,
+        run_after,
+    ))
+    scripts = iter(script for script, _ in funcs)
+    for index, result in enumerate(results):
+        if result is not None:
+            continue
+        script, outcome = next(scripts), next(outcomes)
+        if outcome.start:
+            record_span("switch.hook", outcome.start, outcome.duration, script=str(script), status=outcome.status)
+        results[index] = HookResult(
+            script=str(script),
+            status=outcome.status,
+            error="" if outcome.error is None else str(outcome.error),
+            duration=outcome.duration,
+        )
+    return results
 
 
 def do_switch_jinjas_in_db(
-    switch_to: Literal["lo", "net"], group: str = "*", locale: str = ""
-) -> None:
-    """Render jinja templates stored in the database."""
-    db = SwitchStateDB()
-    templates = db.get_all_jinja_templates()
-    db.close()
+    switch_to: Literal["lo", "net"],
+    group: str = "*",
+    locale: str = "",
+    db: Optional[SwitchStateDB] = None,
+    workers: int = DEFAULT_RENDER_WORKERS,
+    timeout: Optional[float] = None,
+) -> List[TemplateRenderResult]:
+    """
+    Render jinja templates stored in the database. Uses the shared connection if no db is given.
+    Templates are rendered on a pool of worker threads.
+
+    Args:
+        switch_to (str): The state switched to ('lo' or 'net').
+        group (str): The group switched. "*" renders every template, any other group only its own templates.
+        locale (str): The locale switched to.
+        db (Optional[SwitchStateDB]): The database connection.
+        workers (int): Number of templates rendered at once. 1 renders them one after another.
+        timeout (Optional[float]): Seconds each template may take to render. None means no timeout.
+    Returns:
+        List[TemplateRenderResult]: One result per template of the group, in registration order.
+    """
+    return render_templates_for_specs([SwitchSpec(switch_to, group, locale)], db, workers, timeout)
+
+
+def render_templates_for_specs(
+    specs: List[SwitchSpec],
+    db: Optional[SwitchStateDB] = None,
+    workers: int = DEFAULT_RENDER_WORKERS,
+    timeout: Optional[float] = None,
+) -> List[TemplateRenderResult]:
+    """
+    Render the templates affected by a set of switches, each template at most once.
+    A template of a switched group is rendered with that group's switch; if "*" was switched,
+    every other template is rendered with the "*" switch.  Templates registered for "*" are
+    only rendered by "*" switches (see SwitchStateDB.get_jinja_templates_for_group).
 
+    Args:
+        specs (List[SwitchSpec]): The switches in effect, at most one per group (see effective_switch_specs).
+        db (Optional[SwitchStateDB]): The database connection. Defaults to the shared connection.
+        workers (int): Number of templates rendered at once. 1 renders them one after another.
+        timeout (Optional[float]): Seconds each template may take to render. None means no timeout.
+    Returns:
+        List[TemplateRenderResult]: One result per rendered template, in registration order.
+    """
+    if db is None:
+        db = get_shared_db()
+    by_group = {spec.group.lower(): spec for spec in specs if spec.group != "*"}
+    all_spec = next((spec for spec in specs if spec.group == "*"), None)
+    # Rows rather than models: only the path and group are needed.
+    if all_spec is not None:
+        templates = db.get_all_jinja_template_rows()
+    else:
+        # Only load the templates of the switched groups.
+        templates = db.get_jinja_template_rows_for_groups([spec.group for spec in specs])
+    results: List[Optional[TemplateRenderResult]] = []
+    to_render: List[Tuple[Path, Dict[str, Any]]] = []
     for tmpl in templates:
-        if group != "*" and tmpl.group.lower() != group.lower():
+        switch = by_group.get(tmpl.group.lower(), all_spec)
+        if switch is None:
             continue
 
         jinja_path = Path(tmpl.path)
         if not jinja_path.exists():
-            print(f"WARNING: Template {jinja_path} does not exist")
+            results.append(TemplateRenderResult(path=str(jinja_path), status="missing", error="Template does not exist."))
             continue
+        # Filled in once rendered.
+        results.append(None)
+        to_render.append((jinja_path, _template_context(switch)))
 
-        try:
-            from jinja2 import Template
-
-            text = jinja_path.read_text()
-            template = Template(text)
-            rendered = template.render(
-                {
-                    "fie_lonet_switch": {
-                        "switch": {
-                            "switch_to": switch_to,
-                            "group": group,
-                            "locale": locale,
-                        }
-                    }
-                }
+    outcomes = iter(run_concurrently(
+        [lambda item=item: _render_template(*item) for item in to_render],
+        workers,
+        timeout,
+    ))
+    paths = iter(jinja_path for jinja_path, _ in to_render)
+    for index, result in enumerate(results):
+        if result is not None:
+            continue
+        jinja_path, outcome = next(paths), next(outcomes)
+        if outcome.start:
+            record_span("switch.template", outcome.start, outcome.duration, path=str(jinja_path), status=outcome.status)
+        status, error = outcome.status, "" if outcome.error is None else str(outcome.error)
+        if status == "ok":
+            # Only renders that finished in time are written, here on the calling thread.
+            try:
+                status = "rendered" if _write_rendered(jinja_path.with_suffix(""), outcome.value) else "unchanged"
+            except OSError as e:
+                status, error = "failed", str(e)
+        results[index] = TemplateRenderResult(
+            path=str(jinja_path),
+            output_path=str(jinja_path.with_suffix("")),
+            status=status,
+            error=error,
+            duration=outcome.duration,
+        )
+    return results
+
+
+def _template_context(switch: SwitchSpec) -> Dict[str, Any]:
+    return {
+        "fie_lonet_switch": {
+            "switch": {
+                "switch_to": switch.mode,
+                "group": switch.group,
+                "locale": switch.locale,
+            }
+        }
+    }
+
+
+_jinja_environments: Dict[str, Any] = {}
+_jinja_bytecode_cache: Any = None
+_jinja_environments_lock = threading.Lock()
+
+def _get_jinja_environment(directory: Path) -> Any:
+    """
+    Get the jinja2 Environment for templates in a directory.  Environments are kept for the
+    life of the process and share a bytecode cache in the configuration directory, so a
+    template is only compiled again when its source changes.
+    """
+    global _jinja_bytecode_cache
+    key = str(directory)
+    with _jinja_environments_lock:
+        environment = _jinja_environments.get(key)
+        if environment is None:
+            from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+            if _jinja_bytecode_cache is None:
+                # Cache entries are keyed by the template's path and checked against a
+                # hash of its source.
+                cache_dir = get_config_dir() / "jinja_cache"
+                cache_dir.mkdir(exist_ok=True)
+                _jinja_bytecode_cache = FileSystemBytecodeCache(str(cache_dir))
+            environment = Environment(
+                loader=FileSystemLoader(key),
+                bytecode_cache=_jinja_bytecode_cache,
             )
-            output_path = jinja_path.with_suffix("")
-            output_path.write_text(rendered)
-            print(f"Rendered {jinja_path} -> {output_path}")
-        except Exception as e:
-            print(f"Error processing {jinja_path}: {e}")
+            _jinja_environments[key] = environment
+    return environment
+
+
+def _render_template(jinja_path: Path, context: Dict[str, Any]) -> str:
+    """
+    Render a template to a string.  Writing the output is left to the caller: a render that
+    times out keeps running on its thread, and must not write once the caller moved on.
+    """
+    jinja_path = jinja_path.absolute()
+    template = _get_jinja_environment(jinja_path.parent).get_template(jinja_path.name)
+    return template.render(context)
+
+
+def _write_rendered(output_path: Path, rendered: str) -> bool:
+    """Write rendered output. Returns False if the file already had the rendered content."""
+    # Leave identical output alone so its mtime does not wake up file watchers.
+    try:
+        if output_path.read_text() == rendered:
+            return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    output_path.write_text(rendered)
+    return True
+
+
+def print_template_render_results(results: List[TemplateRenderResult]) -> None:
+    """Print a per template report and a summary line for rendered templates."""
+    for result in results:
+        if result.status == "rendered":
+            print(f"Rendered {result.path} -> {result.output_path}")
+        elif result.status == "unchanged":
+            print(f"Unchanged {result.output_path}")
+        elif result.status == "missing":
+            print(f"WARNING: Template {result.path} does not exist")
+        else:
+            print(f"Error processing {result.path}: {result.error}")
+    rendered = sum(1 for result in results if result.status == "rendered")
+    unchanged = sum(1 for result in results if result.status == "unchanged")
+    failed = len(results) - rendered - unchanged
+    print(f"Templates: {rendered} rendered, {unchanged} unchanged, {failed} failed.")
+
+
+def print_hook_results(results: List[HookResult]) -> None:
+    """Print a per script report and a summary line for the homedir switch scripts."""
+    for result in results:
+        if result.status == "ok":
+            print(f"Ran switch_change in {result.script} ({result.duration:.3f}s)")
+        elif result.status == "skipped":
+            print(f"Skipped {result.script}: {result.error}")
+        else:
+            print(f"Error running {result.script}: {result.error}")
+    if results:
+        ok = sum(1 for result in results if result.status == "ok")
+        failed = sum(1 for result in results if result.status in ("failed", "timeout"))
+        print(f"Scripts: {ok} ran, {failed} failed.")
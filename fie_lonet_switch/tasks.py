@@ -0,0 +1,122 @@
+import threading
+import time
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+
+class TaskOutcome(NamedTuple):
+    """The outcome of one function run by run_concurrently()."""
+    status: str  # "ok", "failed" or "timeout"
+    value: Any
+    error: Optional[BaseException]
+    duration: float
+    # When the function started, as time.perf_counter(). 0.0 if it never started.
+    start: float = 0.0
+
+
+def run_concurrently(
+    funcs: List[Callable[[], Any]],
+    workers: int = 1,
+    timeout: Optional[float] = None,
+    run_after: Optional[Sequence[Sequence[int]]] = None,
+) -> List[TaskOutcome]:
+    """
+    Run functions on a pool of worker threads and collect their outcomes.
+
+    Each function gets its own timeout, counted from when a worker starts it.  Python threads
+    cannot be killed, so a function that times out keeps running in the background on a daemon
+    thread; it is no longer waited for and a replacement worker takes over the remaining work.
+    Args:
+        funcs (List[Callable[[], Any]]): The functions to run.
+        workers (int): Maximum number of functions running at once.
+        timeout (Optional[float]): Seconds each function may run. None means no timeout.
+        run_after (Optional[Sequence[Sequence[int]]]): For each function, the indices of functions
+            that must have finished (in any way) before it starts.  Functions caught in a cycle fail.
+    Returns:
+        List[TaskOutcome]: One outcome per function, in the order of funcs.
+    """
+    outcomes: List[Optional[TaskOutcome]] = [None] * len(funcs)
+    if not funcs:
+        return []
+    after = [list(indices) for indices in run_after] if run_after else [[] for _ in funcs]
+
+    if workers <= 1 and timeout is None and not any(after):
+        # Nothing to gain from threads.
+        for index, func in enumerate(funcs):
+            outcomes[index] = _call(func, time.perf_counter())
+        return outcomes
+
+    cond = threading.Condition()
+    queue = list(range(len(funcs)))
+    started = {}
+    remaining = [len(funcs)]
+
+    def ready(index: int) -> bool:
+        return all(outcomes[other] is not None for other in after[index])
+
+    def worker():
+        while True:
+            with cond:
+                while True:
+                    if not queue:
+                        return
+                    index = next((index for index in queue if ready(index)), None)
+                    if index is not None:
+                        break
+                    cond.wait()
+                queue.remove(index)
+                started[index] = time.perf_counter()
+                # Wake the caller so it starts counting this function's timeout.
+                cond.notify_all()
+            outcome = _call(funcs[index], started[index])
+            with cond:
+                if outcomes[index] is not None:
+                    # Timed out and replaced by another worker.
+                    return
+                outcomes[index] = outcome
+                remaining[0] -= 1
+                cond.notify_all()
+
+    def start_worker():
+        threading.Thread(target=worker, name="fie_lonet_switch-task", daemon=True).start()
+
+    for _ in range(min(max(workers, 1), len(funcs))):
+        start_worker()
+
+    with cond:
+        while remaining[0]:
+            wait_for = None
+            now = time.perf_counter()
+            if timeout is not None:
+                for index, start in started.items():
+                    if outcomes[index] is not None:
+                        continue
+                    left = start + timeout - now
+                    if left <= 0:
+                        outcomes[index] = TaskOutcome(
+                            "timeout", None, TimeoutError(f"timed out after {timeout}s"), now - start, start
+                        )
+                        remaining[0] -= 1
+                        if queue:
+                            start_worker()
+                        cond.notify_all()
+                    elif wait_for is None or left < wait_for:
+                        wait_for = left
+            running = any(outcomes[index] is None for index in started)
+            if queue and not running and not any(ready(index) for index in queue):
+                # Whatever is left waits on itself.
+                for index in queue:
+                    outcomes[index] = TaskOutcome("failed", None, ValueError("circular run order"), 0.0)
+                    remaining[0] -= 1
+                queue.clear()
+                cond.notify_all()
+            if remaining[0]:
+                cond.wait(wait_for)
+    return outcomes
+
+
+def _call(func: Callable[[], Any], start: float) -> TaskOutcome:
+    try:
+        value = func()
+    except Exception as e:
+        return TaskOutcome("failed", None, e, time.perf_counter() - start, start)
+    return TaskOutcome("ok", value, None, time.perf_counter() - start, start)
@@ -2,7 +2,11 @@
 
 import rumps
 from fie_lonet_switch.switcher import do_switch
-from fie_lonet_switch.database import SwitchStateDB, get_switch_state_transaction, compact_db_transaction, clear_group_transaction
+from fie_lonet_switch.database import SwitchStateDB, get_shared_db, compact_db_transaction, clear_group_transaction
+
+# Switches are made on the UI thread.  They return once committed and leave templates and
+# scripts to a background worker, and a hanging switch script still only holds up that worker.
+HOOK_TIMEOUT = 30.0
 
 class FIELonetSwitchApp(rumps.App):
     def __init__(self):
@@ -24,30 +28,26 @@ class FIELonetSwitchApp(rumps.App):
         self.tooltip = self.list_all_groups()
 
     def list_all_groups(self):
-        db = SwitchStateDB()
+        db = get_shared_db()
         try:
-            groups = db.get_all_groups()
-            if not groups:
+            states = db.get_all_resolved_states()
+            if not states:
                 return "No groups found."
-            result = []
-            for group in groups:
-                state, locale = get_switch_state_transaction(db, group)
-                result.append(f"Group: {group} | State: {state} | Locale: {locale}")
-            return "\n".join(result)
+            return "\n".join(
+                f"Group: {state.group} | State: {state.mode} | Locale: {state.locale}" for state in states
+            )
         except Exception as e:
             return f"Error: {e}"
-        finally:
-            db.close()
 
     @rumps.clicked("Switch * to Local (lo)")
     def switch_all_lo(self, _):
-        do_switch('lo', '*', '')
+        do_switch('lo', '*', '', hook_timeout=HOOK_TIMEOUT, background="thread")
         self.update_tooltip()
         rumps.notification("FIE Lonet Switch", "Switched", "Switched all groups to local (no locale)")
 
     @rumps.clicked("Switch * to Network (net)")
     def switch_all_net(self, _):
-        do_switch('net', '*', '')
+        do_switch('net', '*', '', hook_timeout=HOOK_TIMEOUT, background="thread")
         self.update_tooltip()
         rumps.notification("FIE Lonet Switch", "Switched", "Switched all groups to network (no locale)")
 
@@ -59,7 +59,7 @@ class FIELonetSwitchApp(rumps.App):
             group = "*"
         if not locale:
             locale = ""
-        do_switch('lo', group, locale)
+        do_switch('lo', group, locale, hook_timeout=HOOK_TIMEOUT, background="thread")
         self.update_tooltip()
         rumps.notification("FIE Lonet Switch", "Switched", f"Switched to local (group: {group}, locale: {locale})")
 
@@ -71,7 +71,7 @@ class FIELonetSwitchApp(rumps.App):
             group = "*"
         if not locale:
             locale = ""
-        do_switch('net', group, locale)
+        do_switch('net', group, locale, hook_timeout=HOOK_TIMEOUT, background="thread")
         self.update_tooltip()
         rumps.notification("FIE Lonet Switch", "Switched", f"Switched to network (group: {group}, locale: {locale})")
 
@@ -0,0 +1,348 @@
+"""
+The user daemon keeps an in-memory copy of the resolved switch state and serves it
+to 3rd party tools over localhost, so polling tools do not have to touch the
+switch_state.sql database.
+
+Discovery and authentication use two files in the configuration directory:
+
+- user_daemon.port: the TCP port the daemon listens on (127.0.0.1 only).
+- user_daemon.key: a random key that clients must present with every request.
+
+The protocol is newline delimited JSON.  Each request is a JSON object with a
+"key" and a "cmd" ("ping", "get", "list" or "invalidate") and is answered with a
+single JSON object line.  A connection may be kept open for any number of requests.
+"""
+import json
+import os
+import secrets
+import socket
+import socketserver
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from fie_lonet_switch.config import get_config_dir
+
+PORT_FILE_NAME = "user_daemon.port"
+KEY_FILE_NAME = "user_daemon.key"
+DEFAULT_HOST = "127.0.0.1"
+
+
+def _daemon_dir_for_db(db_path: Optional[str]) -> Optional[Path]:
+    """The daemon files live next to the database they serve."""
+    if db_path is None:
+        return get_config_dir()
+    if db_path == ":memory:":
+        return None
+    return Path(db_path).parent
+
+
+class ResolvedStateCache:
+    """
+    Thread safe cache of resolved (mode, locale) states per group.
+    States are loaded from the database on a miss and dropped on invalidate().  Notifications
+    are best effort, so every lookup also checks PRAGMA data_version on a connection kept open
+    for that purpose and drops the cache once another connection has committed.  The check
+    costs no disk I/O.
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._states: Dict[str, Tuple[str, str]] = {}
+        self._all_loaded = False
+        self._generation = 0
+        self._version_conn: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._invalidate_locked()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._version_conn is not None:
+                self._version_conn.close()
+                self._version_conn = None
+                self._data_version = None
+
+    def _invalidate_locked(self) -> None:
+        self._states = {}
+        self._all_loaded = False
+        self._generation += 1
+
+    def _check_data_version_locked(self) -> None:
+        """Drop the cache if the database was committed to since the last check."""
+        if self.db_path == ":memory:":
+            return
+        if self._version_conn is None:
+            db_path = self.db_path if self.db_path is not None else get_config_dir() / "switch_state.sql"
+            # Used by the handler threads, always under self._lock.
+            self._version_conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        version = self._version_conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._invalidate_locked()
+
+    def get(self, group: str = "*") -> Tuple[str, str]:
+        """
+        Get the resolved (mode, locale) state for a group.
+        Args:
+            group (str): The group name. Defaults to "*".
+        Returns:
+            Tuple[str, str]: The resolved mode ('lo' or 'net') and locale.
+        """
+        with self._lock:
+            self._check_data_version_locked()
+            state = self._states.get(group)
+            generation = self._generation
+        if state is not None:
+            return state
+        state = self._load_group(group)
+        with self._lock:
+            # Only keep the loaded state if nothing was committed while loading.
+            if generation == self._generation:
+                self._states[group] = state
+        return state
+
+    def get_all(self) -> Dict[str, Tuple[str, str]]:
+        """
+        Get the resolved states of all groups known to the database.
+        Returns:
+            Dict[str, Tuple[str, str]]: The (mode, locale) state per group.
+        """
+        with self._lock:
+            self._check_data_version_locked()
+            if self._all_loaded:
+                return dict(self._states)
+            generation = self._generation
+        states = self._load_all()
+        with self._lock:
+            if generation == self._generation:
+                self._states.update(states)
+                self._all_loaded = True
+        return states
+
+    def _load_group(self, group: str) -> Tuple[str, str]:
+        from fie_lonet_switch.database import SwitchStateDB, get_switch_state_transaction
+
+        db = SwitchStateDB(self.db_path)
+        try:
+            return get_switch_state_transaction(db, group)
+        finally:
+            db.close()
+
+    def _load_all(self) -> Dict[str, Tuple[str, str]]:
+        from fie_lonet_switch.database import SwitchStateDB
+
+        db = SwitchStateDB(self.db_path)
+        try:
+            return {state.group: (state.mode, state.locale) for state in db.get_all_resolved_states()}
+        finally:
+            db.close()
+
+
+class _UserDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline(65536)
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+            except ValueError as e:
+                self._reply({"ok": False, "error": f"Invalid request: {e}"})
+                return
+            if not secrets.compare_digest(str(request.get("key", "")), self.server.key):
+                self._reply({"ok": False, "error": "Invalid key."})
+                return
+            self._reply(self.server.dispatch(request))
+
+    def _reply(self, response: Dict[str, Any]) -> None:
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class _UserDaemonServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], key: str, cache: ResolvedStateCache):
+        super().__init__(address, _UserDaemonHandler)
+        self.key = key
+        self.cache = cache
+
+    def dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        cmd = request.get("cmd")
+        try:
+            if cmd == "ping":
+                return {"ok": True}
+            if cmd == "get":
+                group = request.get("group") or "*"
+                mode, locale = self.cache.get(group)
+                return {"ok": True, "group": group, "mode": mode, "locale": locale}
+            if cmd == "list":
+                states = self.cache.get_all()
+                return {
+                    "ok": True,
+                    "groups": {group: {"mode": mode, "locale": locale} for group, (mode, locale) in states.items()},
+                }
+            if cmd == "invalidate":
+                self.cache.invalidate()
+                return {"ok": True}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": False, "error": f"Unknown command {cmd!r}."}
+
+
+class UserDaemon:
+    """
+    The user daemon.  Serves the resolved switch state from an in-memory cache on
+    localhost and advertises itself through the user_daemon.port and user_daemon.key
+    files next to the database.
+    """
+
+    def __init__(self, db_path: str = None, host: str = DEFAULT_HOST, port: int = 0):
+        daemon_dir = _daemon_dir_for_db(db_path)
+        if daemon_dir is None:
+            raise ValueError("The user daemon cannot serve an in-memory database.")
+        self.port_file = daemon_dir / PORT_FILE_NAME
+        self.key_file = daemon_dir / KEY_FILE_NAME
+        self.key = secrets.token_hex(32)
+        self.cache = ResolvedStateCache(db_path)
+        self.server = _UserDaemonServer((host, port), self.key, self.cache)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def _write_discovery_files(self) -> None:
+        # The key file is written first and only readable by the user, so a client
+        # never finds a port without being able to find its key.
+        fd = os.open(str(self.key_file), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.key)
+        self.port_file.write_text(str(self.port))
+
+    def _remove_discovery_files(self) -> None:
+        # Leave the files alone if another daemon has taken over since.
+        try:
+            if self.port_file.read_text().strip() != str(self.port):
+                return
+        except OSError:
+            return
+        for path in (self.port_file, self.key_file):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def serve_forever(self) -> None:
+        """Advertise the daemon and serve requests until shutdown() is called."""
+        self._write_discovery_files()
+        try:
+            self.server.serve_forever()
+        finally:
+            self._remove_discovery_files()
+            self.server.server_close()
+            self.cache.close()
+
+    def shutdown(self) -> None:
+        self.server.shutdown()
+
+
+class UserDaemonClient:
+    """
+    Client for a running user daemon.  The connection is kept open between requests
+    so frequent polling only costs a localhost round trip.
+    Raises ConnectionError if no daemon is running.
+    """
+
+    def __init__(self, db_path: str = None, timeout: float = 1.0):
+        daemon_dir = _daemon_dir_for_db(db_path)
+        if daemon_dir is None:
+            raise ConnectionError("No user daemon serves an in-memory database.")
+        try:
+            self.port = int((daemon_dir / PORT_FILE_NAME).read_text().strip())
+            self.key = (daemon_dir / KEY_FILE_NAME).read_text().strip()
+        except (OSError, ValueError) as e:
+            raise ConnectionError("The user daemon is not running.") from e
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def request(self, cmd: str, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Send a request to the daemon and return its response.
+        Args:
+            cmd (str): The command ("ping", "get", "list" or "invalidate").
+            **kwargs: Additional request fields, e.g. group.
+        Returns:
+            Dict[str, Any]: The response.  Raises RuntimeError if the daemon reports an error.
+        """
+        if self._sock is None:
+            self._sock = socket.create_connection((DEFAULT_HOST, self.port), timeout=self.timeout)
+            self._file = self._sock.makefile("rwb")
+        payload = dict(kwargs, key=self.key, cmd=cmd)
+        try:
+            self._file.write(json.dumps(payload).encode("utf-8") + b"\n")
+            self._file.flush()
+            line = self._file.readline()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError("The user daemon closed the connection.")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise RuntimeError(response.get("error", "Unknown user daemon error."))
+        return response
+
+    def get_state(self, group: str = "*") -> Tuple[str, str]:
+        """Get the resolved (mode, locale) state for a group."""
+        response = self.request("get", group=group)
+        return response["mode"], response["locale"]
+
+    def list_states(self) -> Dict[str, Tuple[str, str]]:
+        """Get the resolved (mode, locale) state of all groups."""
+        response = self.request("list")
+        return {group: (state["mode"], state["locale"]) for group, state in response["groups"].items()}
+
+    def invalidate(self) -> None:
+        self.request("invalidate")
+
+
+def notify_user_daemon(db_path: str = None, timeout: float = 0.5) -> bool:
+    """
+    Tell a running user daemon that the switch state has changed.  Silent if no
+    daemon is running.
+    Args:
+        db_path (str): The database the change was committed to. Defaults to the user's database.
+        timeout (float): Connection timeout in seconds.
+    Returns:
+        bool: True if a daemon was notified.
+    """
+    try:
+        with UserDaemonClient(db_path, timeout=timeout) as client:
+            client.invalidate()
+        return True
+    except (ConnectionError, OSError, RuntimeError, ValueError):
+        return False
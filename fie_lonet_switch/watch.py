@@ -0,0 +1,82 @@
+"""
+Change notifications for the switch state.
+
+subscribe() yields an event whenever the resolved state of a group changes, in this or any
+other process.  Commits are detected with SQLite's PRAGMA data_version, which only changes when
+another connection commits and costs no disk I/O to check, so an idle subscriber never reads
+the database.
+"""
+import threading
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from fie_lonet_switch.database import SwitchStateDB
+
+# Seconds between checks for new commits.
+DEFAULT_POLL_INTERVAL = 0.1
+
+
+class StateChangeEvent(NamedTuple):
+    """The new resolved state of a group."""
+    group: str
+    mode: str
+    locale: str
+    # When the change now in effect was made; empty if the group fell back to the default state.
+    c_time: str
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"group": self.group, "mode": self.mode, "locale": self.locale, "timestamp": self.c_time}
+
+
+def subscribe(
+    db_path: str = None,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    initial: bool = False,
+    stop: Optional[threading.Event] = None,
+) -> Iterator[StateChangeEvent]:
+    """
+    Yield the resolved state of every group whose state changes, as it changes.  Switching a
+    group again counts as a change even if its mode and locale stay the same.  A "*" switch
+    yields an event for "*" and for every group it overrides.  A group that is cleared yields
+    the state it falls back to.
+
+    Args:
+        db_path (str): The database to watch. Defaults to the user's database.
+        poll_interval (float): Seconds between checks for new commits.
+        initial (bool): Start with an event for every group's current state.
+        stop (Optional[threading.Event]): Stop watching once this is set.
+    Returns:
+        Iterator[StateChangeEvent]: The change events, in commit order.
+    """
+    if stop is None:
+        stop = threading.Event()
+    db = SwitchStateDB(db_path)
+    try:
+        version = _data_version(db)
+        states = _resolved_states(db)
+        if initial:
+            for event in states.values():
+                yield event
+        while not stop.wait(poll_interval):
+            new_version = _data_version(db)
+            if new_version == version:
+                continue
+            version = new_version
+            new_states = _resolved_states(db)
+            for group, event in new_states.items():
+                if states.get(group) != event:
+                    yield event
+            fallback = new_states.get("*", StateChangeEvent("*", "lo", "", ""))
+            for group in states:
+                if group not in new_states:
+                    yield StateChangeEvent(group, fallback.mode, fallback.locale, fallback.c_time)
+            states = new_states
+    finally:
+        db.close()
+
+
+def _data_version(db: SwitchStateDB) -> int:
+    return db.conn.execute('PRAGMA data_version').fetchone()[0]
+
+
+def _resolved_states(db: SwitchStateDB) -> Dict[str, StateChangeEvent]:
+    return {state.group: StateChangeEvent(*state) for state in db.get_all_resolved_states()}